@@ -0,0 +1,328 @@
+import argparse
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from ns_analog import get_analog_data, iter_analog_chunks
+from ns_cache import CACHE_HEADER_SIZE, cache_file_path, nev_packet_dtype, write_nev_cache
+from ns_digital import DIGITAL_INPUTS, get_digital_edges, get_digital_events
+from ns_events import EventIndex, get_event_times
+from ns_openfile import ns_closefile, ns_openfile
+from ns_segment import get_segment_data
+from ns_synthetic import write_synthetic_nev, write_synthetic_nsx
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Benchmarks of opening, indexing and reading NEV/NSx files, on sample.nev and on
+# synthetic files of configurable size. Every benchmark also checks its results
+# against a plain NumPy read of the raw file.
+
+DIGITAL_REASONS = ['Parallel Input', 'SMA 1', 'SMA 2', 'SMA 3', 'SMA 4', 'Output Echo']
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None when unknown)."""
+    # VmHWM starts over at exec, unlike ru_maxrss which keeps the peak of the parent process
+    try:
+        with open('/proc/self/status') as fid:
+            for line in fid:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def report(name, seconds, n_items=None, unit='packets', n_bytes=None):
+    rates = []
+    if n_items is not None:
+        rates.append(f'{n_items / seconds:,.0f} {unit}/s')
+    if n_bytes is not None:
+        rates.append(f'{n_bytes / seconds / 1e6:,.0f} MB/s')
+    print(f'\t{name}: {seconds * 1e3:10.2f} ms' + (f" ({', '.join(rates)})" if rates else ''))
+
+
+def report_rss():
+    peak = peak_rss_mb()
+    if peak is not None:
+        print(f'\tpeak RSS: {peak:,.0f} MB')
+
+
+def read_nev_packets(nev_file):
+    # Reference reader: the packet headers straight from the file, without any cache
+    with open(nev_file, 'rb') as fid:
+        fid.seek(12)
+        bytes_headers, bytes_data_packet = struct.unpack('<II', fid.read(8))
+    return np.memmap(nev_file, dtype=nev_packet_dtype(bytes_data_packet), mode='r', offset=bytes_headers)
+
+
+def write_nev_cache_loop(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets):
+    # Reference implementation: one read/unpack/seek per packet and column
+    with open(filepath, 'rb') as fid, open(cache_file_name, 'wb') as cache_id:
+        for offset, fmt in ((0, '<I'), (4, '<H'), (6, 'B')):
+            size = struct.calcsize(fmt)
+            fid.seek(bytes_headers + offset, os.SEEK_SET)
+            for _ in range(n_data_packets):
+                value = struct.unpack(fmt, fid.read(size))[0]
+                cache_id.write(struct.pack(fmt, value))
+                fid.seek(bytes_data_packet - size, os.SEEK_CUR)
+
+
+def benchmark_cache(nev_file, tmp_dir, loop=True):
+    with open(nev_file, 'rb') as fid:
+        fid.seek(12)
+        bytes_headers, bytes_data_packet = struct.unpack('<II', fid.read(8))
+    n_data_packets = (os.path.getsize(nev_file) - bytes_headers) // bytes_data_packet
+    n_bytes = os.path.getsize(nev_file)
+    print(f'{os.path.basename(nev_file)}: {n_data_packets} packets, {n_bytes / 1e6:,.1f} MB')
+
+    builds = [('vectorized', write_nev_cache)]
+    if loop:
+        builds.insert(0, ('loop', write_nev_cache_loop))
+    for name, build in builds:
+        cache_file_name = os.path.join(tmp_dir, f'{name}.cache')
+        start = time.perf_counter()
+        build(nev_file, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets)
+        report(f'cache build ({name})', time.perf_counter() - start, n_data_packets)
+
+    if loop:
+        with open(os.path.join(tmp_dir, 'loop.cache'), 'rb') as a, \
+                open(os.path.join(tmp_dir, 'vectorized.cache'), 'rb') as b:
+            # The vectorized cache also holds the key counts after the columns
+            b.seek(CACHE_HEADER_SIZE)
+            columns = a.read()
+            assert columns == b.read(len(columns)), 'cache files differ'
+
+
+def benchmark_open(nev_file):
+    # Cold means that no cache file exists yet; the OS page cache is not dropped
+    n_bytes = os.path.getsize(nev_file)
+    cache_file_name = cache_file_path(nev_file)
+    if os.path.exists(cache_file_name):
+        os.remove(cache_file_name)
+    for name in ('cold', 'warm'):
+        start = time.perf_counter()
+        ns_result, hfile = ns_openfile(nev_file, single=True, stats=True)
+        seconds = time.perf_counter() - start
+        assert ns_result == 'ns_OK'
+        report(f'ns_openfile ({name})', seconds, len(hfile.file_info.memory_map), n_bytes=n_bytes)
+        stats = hfile.file_info.stats
+        phases = ', '.join(f'{phase} {seconds * 1e3:.2f} ms' for phase, seconds in stats.phases.items())
+        print(f'\t\t{phases}; {stats.bytes_read:,} bytes read, {stats.seeks} seeks, cache {stats.cache}')
+        ns_closefile(hfile)
+
+
+def benchmark_entities(nev_file):
+    ns_result, hfile = ns_openfile(nev_file, single=True)
+    data = hfile.file_info.memory_map
+
+    start = time.perf_counter()
+    event_index = EventIndex(data['TimeStamp'], data['PacketID'], data['Class'])
+    report('entity counting (key counts)', time.perf_counter() - start, len(data))
+    start = time.perf_counter()
+    event_index.order
+    report('event index order (first lookup)', time.perf_counter() - start, len(data))
+
+    # Check the index and every entity count against the raw packets
+    packets = read_nev_packets(nev_file)
+    packet_ids, classes = packets['PacketID'], packets['Class']
+    keys, counts = np.unique((packet_ids.astype(np.uint32) << 8) | classes, return_counts=True)
+    assert np.array_equal(keys, event_index.keys) and np.array_equal(counts, event_index.counts)
+    assert np.array_equal(event_index.order, np.argsort((packet_ids.astype(np.uint32) << 8) | classes,
+                                                        kind='stable'))
+    assert np.array_equal(hfile.file_info.event_index.counts, counts)
+
+    for entity in hfile.entity:
+        if entity.entity_type == 'Segment':
+            expected = np.count_nonzero(packet_ids == entity.electrode_id)
+        elif entity.entity_type == 'Event':
+            bit = 1 << DIGITAL_REASONS.index(entity.reason)
+            expected = np.count_nonzero((packet_ids == 0) & (classes & bit != 0))
+        else:
+            expected = np.count_nonzero((packet_ids == entity.electrode_id) & (classes == entity.reason))
+        assert entity.count == expected, f'count of entity {entity.electrode_id}/{entity.reason}'
+    ns_closefile(hfile)
+
+
+def benchmark_lookups(nev_file):
+    ns_result, hfile = ns_openfile(nev_file, single=True)
+    electrodes = sorted({e.electrode_id for e in hfile.entity if e.entity_type == 'Segment'})
+
+    start = time.perf_counter()
+    n_events = 0
+    for electrode_id in electrodes:
+        ns_result, times = get_event_times(hfile, electrode_id)
+        n_events += len(times)
+    report(f'get_event_times ({len(electrodes)} electrodes)', time.perf_counter() - start, n_events,
+           unit='events')
+
+    packets = read_nev_packets(nev_file)
+    for electrode_id in electrodes[:4]:
+        ns_result, times = get_event_times(hfile, electrode_id)
+        assert np.array_equal(times, packets['TimeStamp'][packets['PacketID'] == electrode_id])
+    ns_closefile(hfile)
+
+
+def benchmark_digital(nev_file):
+    ns_result, hfile = ns_openfile(nev_file, single=True)
+    start = time.perf_counter()
+    ns_result, events = get_digital_events(hfile)
+    edges = {name: get_digital_edges(hfile, name, events=events)[1] for name in DIGITAL_INPUTS}
+    report('digital events and edges', time.perf_counter() - start, len(events['TimeStamp']), unit='events')
+
+    # Check the SMA edges against the levels in the raw packets (byte 8 + 2j)
+    packets = read_nev_packets(nev_file)
+    raw = np.memmap(nev_file, dtype='u1', mode='r', offset=hfile.file_info.bytes_headers,
+                    shape=(len(packets), hfile.file_info.bytes_data_packet))
+    for j in range(1, 5):
+        changed = (packets['PacketID'] == 0) & (packets['Class'] & (1 << j) != 0)
+        high = raw[changed, 8 + 2 * j:10 + 2 * j].copy().view('<u2')[:, 0] != 0
+        assert np.array_equal(edges[DIGITAL_INPUTS[j]]['Rising'], packets['TimeStamp'][changed][high])
+        assert np.array_equal(edges[DIGITAL_INPUTS[j]]['Falling'], packets['TimeStamp'][changed][~high])
+    ns_closefile(hfile)
+
+
+def benchmark_segments(nev_file):
+    ns_result, hfile = ns_openfile(nev_file, single=True)
+    segments = [e for e in hfile.entity if e.entity_type == 'Segment']
+    start = time.perf_counter()
+    n_spikes = n_bytes = 0
+    for entity in segments:
+        ns_result, data = get_segment_data(hfile, entity, scale=False)
+        n_spikes += len(data)
+        n_bytes += data.nbytes
+    report(f'get_segment_data ({len(segments)} entities)', time.perf_counter() - start, n_spikes,
+           unit='waveforms', n_bytes=n_bytes)
+
+    # Check one entity against the bytes following the 8 byte packet header
+    entity = segments[0]
+    packet_ids = read_nev_packets(nev_file)['PacketID']
+    raw = np.memmap(nev_file, dtype='u1', mode='r', offset=hfile.file_info.bytes_headers,
+                    shape=(len(packet_ids), hfile.file_info.bytes_data_packet))
+    ns_result, data = get_segment_data(hfile, entity, scale=False)
+    expected = raw[packet_ids == entity.electrode_id, 8:8 + data.shape[1] * data.itemsize]
+    assert np.array_equal(data, expected.copy().view(data.dtype))
+    ns_closefile(hfile)
+
+
+def benchmark_analog(nsx_file, window=30000):
+    start = time.perf_counter()
+    ns_result, hfile = ns_openfile(nsx_file, single=True)
+    seconds = time.perf_counter() - start
+    file_info = hfile.file_info
+    print(f'{os.path.basename(nsx_file)}: {file_info.file_type_id}, {hfile.entity[0].count} points x '
+          f'{len(hfile.entity)} channels in {len(file_info.blocks)} blocks, '
+          f'{os.path.getsize(nsx_file) / 1e6:,.1f} MB')
+    report('ns_openfile', seconds)
+
+    channels = list(range(len(hfile.entity)))
+    middle = hfile.entity[0].count // 2
+    start = time.perf_counter()
+    ns_result, data = get_analog_data(hfile, 0, middle, window)
+    report(f'get_analog_data (1 channel, {window} points)', time.perf_counter() - start, n_bytes=data.nbytes)
+
+    start = time.perf_counter()
+    ns_result, data = get_analog_data(hfile, channels, middle, window, scale=False)
+    report(f'get_analog_data (all channels, {window} points)', time.perf_counter() - start,
+           n_bytes=data.nbytes)
+
+    start = time.perf_counter()
+    n_bytes = 0
+    ns_result, chunks = iter_analog_chunks(hfile, channels, 300000, scale=False)
+    for chunk in chunks:
+        n_bytes += chunk['Data'].nbytes
+    report('iter_analog_chunks (all channels, whole file)', time.perf_counter() - start, n_bytes=n_bytes)
+
+    # Check against the samples of every block read straight from the file
+    raw = np.concatenate([
+        np.fromfile(nsx_file, dtype=file_info.sample_dtype, count=int(block['NumPoints']) * len(channels),
+                    offset=int(block['Offset'])).reshape(-1, len(channels))
+        for block in file_info.blocks
+    ])
+    assert np.array_equal(data, raw[middle:middle + window]) and n_bytes == raw.nbytes
+    ns_closefile(hfile)
+
+
+def benchmark_import(module='ns_openfile', repeat=5):
+    # Each measurement runs in a fresh interpreter so no module is already imported
+    code = (f'import sys, time; start = time.perf_counter(); import {module}; '
+            f'print(time.perf_counter() - start, "tkinter" in sys.modules)')
+    seconds = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        seconds.append(float(output[0]))
+    print(f'import {module}: {min(seconds) * 1e3:8.1f} ms (best of {repeat}, tkinter imported: {output[1]})')
+
+
+def benchmark_nev(nev_file, tmp_dir, loop=True):
+    benchmark_cache(nev_file, tmp_dir, loop)
+    benchmark_open(nev_file)
+    benchmark_entities(nev_file)
+    benchmark_lookups(nev_file)
+    benchmark_digital(nev_file)
+    benchmark_segments(nev_file)
+    os.remove(cache_file_path(nev_file))
+
+
+def run_isolated(group, *args):
+    # Each group runs in a fresh interpreter, so its peak RSS does not include the groups before it
+    sys.stdout.flush()
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--run', group, *args], check=True)
+
+
+def run_group(group, *args):
+    if group == 'nev':
+        nev_file, tmp_dir, loop = args
+        benchmark_nev(nev_file, tmp_dir, loop=loop == 'loop')
+    else:
+        benchmark_analog(*args)
+    report_rss()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark opening and reading NEV/NSx files.")
+    parser.add_argument('n_packets', nargs='?', type=int, default=2000000,
+                        help="packets of the synthetic NEV file and points of the NSx files")
+    parser.add_argument('--electrodes', type=int, default=32, help="electrodes of the synthetic NEV file")
+    parser.add_argument('--digital', type=float, default=0.1, help="fraction of digital event packets")
+    parser.add_argument('--channels', type=int, default=32, help="channels of the synthetic NSx files")
+    parser.add_argument('--blocks', type=int, default=3, help="data blocks of the synthetic NSx files")
+    parser.add_argument('--no-loop', action='store_true', help="skip the per-packet reference cache build")
+    parser.add_argument('--keep', metavar='DIR', default=None, help="write the synthetic files to DIR")
+    parser.add_argument('--run', nargs='+', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run is not None:
+        run_group(*args.run)
+        return
+
+    benchmark_import()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.keep or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        run_isolated('nev', 'sample.nev', tmp_dir, 'loop')
+
+        synthetic_nev = os.path.join(data_dir, 'synthetic.nev')
+        write_synthetic_nev(synthetic_nev, args.n_packets, args.electrodes, digital_fraction=args.digital)
+        run_isolated('nev', synthetic_nev, tmp_dir, 'no-loop' if args.no_loop else 'loop')
+
+        for name, float_stream in (('synthetic.ns5', False), ('synthetic-float.ns5', True)):
+            synthetic_nsx = os.path.join(data_dir, name)
+            write_synthetic_nsx(synthetic_nsx, args.n_packets, args.channels, args.blocks,
+                                float_stream=float_stream)
+            run_isolated('analog', synthetic_nsx)
+
+
+if __name__ == '__main__':
+    main()
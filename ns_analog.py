@@ -0,0 +1,172 @@
+import os
+import struct
+import warnings
+import numpy as np
+
+# One row per NSx data packet: file offset of the first sample, start timestamp (in
+# units of the file's time resolution) and number of points per channel
+nsx_block_dtype = np.dtype([('Offset', '<u8'), ('TimeStamp', '<u4'), ('NumPoints', '<u4')])
+
+
+def scan_nsx_blocks(fid, bytes_headers, file_size, chan_count, bytes_per_point):
+    """Build the data block index of an NSx file.
+
+    Each data packet is a 9 byte header (Header, Timestamp, Number of Data Points)
+    followed by NumPoints x chan_count samples, so only the headers are read. A
+    truncated last block is clipped to the samples actually present in the file.
+    """
+    blocks = []
+    offset = bytes_headers
+    bytes_per_sample = bytes_per_point * chan_count
+
+    while offset + 9 <= file_size:
+        fid.seek(offset, os.SEEK_SET)
+        header, time_stamp, n_points = struct.unpack('<BII', fid.read(9))
+        offset += 9
+
+        n_available = (file_size - offset) // bytes_per_sample if bytes_per_sample else 0
+        if n_points > n_available:
+            warnings.warn(f"corrupted nsx file {fid.name}: the data block at offset {offset - 9} "
+                          f"holds {n_available} of its {n_points} points", stacklevel=2)
+            n_points = n_available
+
+        blocks.append((offset, time_stamp, n_points))
+        offset += n_points * bytes_per_sample
+
+    return np.array(blocks, dtype=nsx_block_dtype)
+
+
+def analog_block_view(file_info, i_block):
+    """Memory-mapped (NumPoints, chan_count) view of one NSx data block."""
+    views = file_info.block_views
+    if views[i_block] is None:
+        block = file_info.blocks[i_block]
+        views[i_block] = np.memmap(file_info.file_name, dtype=file_info.sample_dtype, mode='r',
+                                   offset=int(block['Offset']),
+                                   shape=(int(block['NumPoints']), file_info.chan_count))
+    return views[i_block]
+
+
+def get_analog_data(hfile, entity, start=0, count=None, scale=True):
+    """Read samples of one or more Analog entities.
+
+    entity is an Entity or an index into hfile.entity, or a list of them for a channel
+    set. start and count are sample indices across all data blocks of the file. Only
+    the requested samples are read from disk. With scale=True the samples are
+    converted to entity units as float32; otherwise the raw int16 (or float32)
+    samples are returned.
+
+    Returns (ns_result, data) where data has shape (count,) for a single entity and
+    (count, n_entities) for a channel set.
+    """
+    entities = entity if isinstance(entity, (list, tuple)) else [entity]
+    entities = [hfile.get_entity(e) for e in entities]
+    if not entities or any(e.entity_type != 'Analog' for e in entities):
+        return 'ns_BADENTITY', None
+
+    # A channel set must come from a single NSx file
+    file_info = entities[0].file_info
+    if any(e.file_info is not file_info for e in entities):
+        return 'ns_BADENTITY', None
+    if file_info.blocks is None:  # closed handle
+        return 'ns_BADFILE', None
+
+    n_samples = int(file_info.blocks['NumPoints'].sum())
+    if count is None:
+        count = n_samples - start
+    if start < 0 or count < 0 or start + count > n_samples:
+        return 'ns_BADINDEX', None
+
+    channels = [e.channel_index for e in entities]
+    data = np.empty((count, len(channels)), dtype=file_info.sample_dtype)
+
+    # Copy the overlapping part of every block that intersects [start, start + count)
+    block_starts = np.concatenate(([0], np.cumsum(file_info.blocks['NumPoints'], dtype=np.int64)))
+    first = np.searchsorted(block_starts, start, side='right') - 1
+    position = 0
+    for i_block in range(max(first, 0), len(file_info.blocks)):
+        if position == count:
+            break
+        a = start + position - block_starts[i_block]
+        b = min(block_starts[i_block + 1] - block_starts[i_block], a + count - position)
+        if b <= a:
+            continue
+        data[position:position + b - a] = analog_block_view(file_info, i_block)[a:b, channels]
+        position += b - a
+
+    if scale:
+        data = data * np.array([e.scale for e in entities], dtype=np.float32)
+
+    if not isinstance(entity, (list, tuple)):
+        data = data[:, 0]
+
+    return 'ns_OK', data
+
+
+def iter_analog_chunks(hfile, channels, chunk_samples=30000, overlap=0, stages=(), scale=True):
+    """Stream the samples of a channel set in chunks of bounded size.
+
+    channels is a list of Analog entities (or indices into hfile.entity) from one NSx
+    file. Chunks never span two data blocks, so each yielded item maps Block,
+    TimeStamp (timestamp of its first sample), Period (timestamp ticks per sample) and
+    Data, a (n_points, n_channels) array of at most chunk_samples samples. With
+    overlap > 0 every chunk also repeats the last overlap samples of the previous one
+    in the same block.
+
+    stages are callables from ns_filters (e.g. BandpassFilter, Decimator) applied in
+    order to each chunk. They keep their state from one chunk to the next and are
+    reset at every block, and TimeStamp and Period account for their delay and
+    decimation. overlap must be 0 when stages are given.
+
+    Returns (ns_result, chunks) where chunks is a generator.
+    """
+    entities = [hfile.get_entity(e) for e in channels]
+    if not entities or any(e.entity_type != 'Analog' for e in entities):
+        return 'ns_BADENTITY', None
+    file_info = entities[0].file_info
+    if any(e.file_info is not file_info for e in entities):
+        return 'ns_BADENTITY', None
+    if file_info.blocks is None:  # closed handle
+        return 'ns_BADFILE', None
+    if chunk_samples <= 0 or overlap < 0 or overlap >= chunk_samples or (stages and overlap):
+        return 'ns_BADINDEX', None
+
+    # Output sample j of a block corresponds to input sample j * factor - delay
+    factor, delay = 1, 0
+    for stage in stages:
+        delay += stage.delay * factor
+        factor *= stage.factor
+
+    def chunks():
+        channel_index = [e.channel_index for e in entities]
+        scales = np.array([e.scale for e in entities], dtype=np.float32)
+        for i_block, block in enumerate(file_info.blocks):
+            for stage in stages:
+                stage.reset()
+            view = analog_block_view(file_info, i_block)
+            n_points = int(block['NumPoints'])
+            n_out = 0
+
+            for position in range(0, n_points, chunk_samples):
+                first = max(position - overlap, 0)
+                data = view[first:position + chunk_samples, channel_index]
+                if scale:
+                    data = data * scales
+                for stage in stages:
+                    data = stage(data)
+                if not len(data):
+                    continue
+
+                if stages:
+                    time_stamp = int(block['TimeStamp']) + (n_out * factor - delay) * file_info.period
+                    n_out += len(data)
+                else:
+                    time_stamp = int(block['TimeStamp']) + first * file_info.period
+                yield {
+                    'Block': i_block,
+                    'TimeStamp': time_stamp,
+                    'Period': factor * file_info.period,
+                    'Data': data,
+                }
+
+    return 'ns_OK', chunks()
@@ -0,0 +1,243 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ns_openfile import Entity, index_nsx_blocks, is_valid_file, map_nev_data, ns_closefile, ns_openfile
+
+# Batch indexing of recording sessions across a directory tree. Each session (all
+# files sharing a base name) is opened in a worker process, which builds its caches,
+# and summarised in a JSON manifest.
+
+MANIFEST_VERSION = 1
+
+
+def find_sessions(paths):
+    """Session base paths (directory + base name) under directories or glob patterns."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.extend(glob.glob(path, recursive=True))
+
+    sessions = {os.path.splitext(file)[0] for file in files if is_valid_file(file)}
+    return sorted(sessions)
+
+
+def json_value(value):
+    # NumPy scalars (counts, classes, time spans) are converted to plain Python values
+    return value.item() if hasattr(value, 'item') else value
+
+
+def summarize_hfile(hfile):
+    files = []
+    for file_info in hfile.file_infos:
+        stat = os.stat(file_info.file_name)
+        files.append({
+            'file_name': os.path.abspath(file_info.file_name),
+            'type': file_info.type,
+            'file_type_id': file_info.file_type_id,
+            'file_size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'label': file_info.label,
+            'time_span': json_value(file_info.time_span),
+            'cache_file_name': file_info.cache_file_name and os.path.abspath(file_info.cache_file_name),
+        })
+
+    entities = []
+    for entity in hfile.entity:
+        entities.append({
+            'file': hfile.file_infos.index(entity.file_info),
+            'electrode_id': json_value(entity.electrode_id),
+            'entity_type': entity.entity_type,
+            'reason': json_value(entity.reason),
+            'count': json_value(entity.count),
+            'scale': json_value(entity.scale),
+            'units': entity.units,
+            'label': entity.label,
+        })
+
+    return {'files': files, 'entity': entities, 'time_span': json_value(hfile.time_span)}
+
+
+def index_session(session, cache_dir=None, cache_max_bytes=None):
+    """Open one session and summarise it; failures are reported rather than raised."""
+    start = time.perf_counter()
+    try:
+        ns_result, hfile = ns_openfile(session, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes)
+        if ns_result != 'ns_OK':
+            raise OSError(f"{ns_result}: no readable NEV/NSx files")
+        summary = summarize_hfile(hfile)
+        ns_closefile(hfile)
+        summary['status'] = 'ok'
+    except Exception as error:
+        summary = {'status': 'error', 'error': f"{type(error).__name__}: {error}"}
+
+    summary['session'] = os.path.abspath(session)
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def print_progress(done, total, summary):
+    status = summary['status'] if summary['status'] == 'ok' else summary['error']
+    print(f"[{done}/{total}] {summary['session']}: {status} ({summary['seconds']:.2f} s)",
+          file=sys.stderr)
+
+
+def index_sessions(paths, max_workers=None, cache_dir=None, cache_max_bytes=None, manifest=None,
+                   progress=print_progress):
+    """Index every session found under paths on a process pool.
+
+    paths are directories (searched recursively) or glob patterns. Sessions are
+    dispatched to max_workers processes; a failing session is recorded in the
+    manifest with its error instead of aborting the batch. If a worker process dies,
+    its session and the sessions not yet finished are recorded as failed with
+    BrokenProcessPool, and can be indexed again in a later run. progress is called with
+    (done, total, summary) as sessions finish. If manifest is a file name the
+    manifest is also written there as JSON.
+    """
+    sessions = find_sessions([paths] if isinstance(paths, str) else paths)
+    summaries = {}
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(index_session, session, cache_dir, cache_max_bytes): session
+                   for session in sessions}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                summary = future.result()
+            except Exception as error:
+                # A worker that crashed or was killed (e.g. out of memory) breaks the pool;
+                # its session and those still pending are recorded as failed
+                summary = {'status': 'error', 'error': f"{type(error).__name__}: {error}",
+                           'session': os.path.abspath(futures[future]),
+                           'seconds': time.perf_counter() - start}
+            summaries[summary['session']] = summary
+            if progress is not None:
+                progress(done, len(sessions), summary)
+
+    result = {
+        'version': MANIFEST_VERSION,
+        'cache_dir': cache_dir and os.path.abspath(cache_dir),
+        'sessions': [summaries[os.path.abspath(session)] for session in sessions],
+    }
+    if manifest is not None:
+        write_manifest(result, manifest)
+    return result
+
+
+def write_manifest(result, manifest):
+    tmp_manifest = f"{manifest}.tmp"
+    with open(tmp_manifest, 'w') as fid:
+        json.dump(result, fid, separators=(',', ':'))
+    os.replace(tmp_manifest, manifest)
+
+
+def read_manifest(manifest):
+    with open(manifest) as fid:
+        return json.load(fid)
+
+
+def is_current(summary, hfile):
+    """True if the files of a manifest entry are those of hfile and have not changed since."""
+    if summary is None or summary['status'] != 'ok':
+        return False
+    if [record['file_name'] for record in summary['files']] != \
+            [os.path.abspath(file_info.file_name) for file_info in hfile.file_infos]:
+        return False
+    for record in summary['files']:
+        stat = os.stat(record['file_name'])
+        if stat.st_size != record['file_size'] or stat.st_mtime_ns != record['mtime_ns']:
+            return False
+    return True
+
+
+def seed_file_info(file_info, records, time_span, cache_dir=None, cache_max_bytes=None):
+    """Give a header-only FileInfo the entities and time span recorded in a manifest.
+
+    Segment and Analog entities keep the objects read from the headers (with their
+    waveform size or channel index); the others are created from the records. The
+    data pass is replaced by one that only maps the NEV cache or indexes the NSx data
+    blocks, and reading counts or time spans does not run it.
+    """
+    declared = {(entity.entity_type, entity.electrode_id): entity for entity in file_info.entity}
+    file_info.entity, file_info.neural_entity = [], []
+    for record in records:
+        entity = declared.get((record['entity_type'], record['electrode_id']))
+        if entity is None:
+            entity = Entity(file_info)
+            entity.electrode_id = record['electrode_id']
+            # Manifests written before neural entities had a type record None
+            entity.entity_type = record['entity_type'] or 'Neural'
+            entity.reason = record['reason']
+            entity.scale = record['scale']
+            entity.units = record['units']
+            entity.label = record['label']
+        entity.count = record['count']
+        if entity.entity_type == 'Neural':
+            file_info.neural_entity.append(entity)
+        else:
+            file_info.entity.append(entity)
+    file_info.electrode_list = [entity.electrode_id for entity in file_info.entity]
+    file_info.time_span = time_span
+    file_info.counted = True
+
+    if file_info.file_type_id == 'NEURALEV':
+        file_info.loader = lambda: map_nev_data(file_info, cache_dir, cache_max_bytes)
+    else:
+        file_info.loader = lambda: index_nsx_blocks(file_info)
+
+
+def open_session(manifest, session, **kwargs):
+    """Open a session listed in a manifest, reusing what the batch run recorded.
+
+    If the files of the session have the size and modification time recorded in the
+    manifest, only their headers are read: entities, counts and time spans are taken
+    from the manifest, and the data pass just maps the caches built by the batch run.
+    Otherwise the session is opened with ns_openfile as usual.
+    """
+    if isinstance(manifest, str):
+        manifest = read_manifest(manifest)
+    kwargs.setdefault('cache_dir', manifest['cache_dir'])
+    lazy = kwargs.pop('lazy', False)
+
+    ns_result, hfile = ns_openfile(session, lazy=True, **kwargs)
+    base_path = os.path.abspath(os.path.splitext(session)[0] if is_valid_file(session) else session)
+    summary = next((summary for summary in manifest['sessions'] if summary['session'] == base_path), None)
+    if ns_result == 'ns_OK' and is_current(summary, hfile):
+        for i, file_info in enumerate(hfile.file_infos):
+            records = [record for record in summary['entity'] if record['file'] == i]
+            seed_file_info(file_info, records, summary['files'][i]['time_span'], kwargs['cache_dir'],
+                           kwargs.get('cache_max_bytes'))
+        hfile.update()
+
+    if not lazy:
+        hfile.load(kwargs.get('max_workers'))
+    return ns_result, hfile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index Ripple NEV/NSx sessions and write a manifest.")
+    parser.add_argument('paths', nargs='+', help="directories (searched recursively) or glob patterns")
+    parser.add_argument('-o', '--manifest', default='manifest.json', help="manifest file to write")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--cache-dir', default=None, help="directory for the cache files")
+    parser.add_argument('--cache-max-bytes', type=int, default=None,
+                        help="size limit of the cache directory")
+    parser.add_argument('-q', '--quiet', action='store_true', help="do not report progress")
+    args = parser.parse_args(argv)
+
+    result = index_sessions(args.paths, args.workers, args.cache_dir, args.cache_max_bytes, args.manifest,
+                            progress=None if args.quiet else print_progress)
+    n_failed = sum(summary['status'] != 'ok' for summary in result['sessions'])
+    print(f"Indexed {len(result['sessions']) - n_failed} sessions ({n_failed} failed) -> {args.manifest}",
+          file=sys.stderr)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
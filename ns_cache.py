@@ -0,0 +1,493 @@
+import contextlib
+import hashlib
+import os
+import struct
+import numpy as np
+from ns_events import count_keys
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# Cache file layout (little-endian):
+#   header (CACHE_HEADER_SIZE bytes, zero padded)
+#       magic, version, source file size, source mtime (ns), BytesHeaders,
+#       BytesDataPacket, number of data packets, capacity, SHA-1 of the source headers,
+#       number of keys
+#   TimeStamp column (uint32 x capacity), PacketID column (uint16 x capacity),
+#   Class column (uint8 x capacity)
+#   key table: PacketID << 8 | Class keys (uint32 x n_keys), packet count of each key
+#   (uint64 x n_keys)
+# The first n entries of each column are valid. Caches of files that are still being
+# recorded are given spare capacity so new packets can be appended in place. The key
+# table gives the entity counts without reading the columns.
+CACHE_MAGIC = b'NSCACHE\x00'
+CACHE_VERSION = 3
+CACHE_HEADER_FORMAT = '<8sIQqIIQQ20sQ'
+CACHE_FIELDS = (('TimeStamp', '<u4'), ('PacketID', '<u2'), ('Class', 'u1'))
+CACHE_HEADER_SIZE = 128
+
+# Cache directory and its size limit can be set from the environment, e.g. on a cluster
+# where the data shares are read-only
+CACHE_DIR = os.environ.get('NS_CACHE_DIR')
+CACHE_MAX_BYTES = int(os.environ.get('NS_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ns_openfile')
+
+
+def nev_packet_dtype(bytes_data_packet):
+    """Structured dtype for one NEV data packet header, strided to the full packet size."""
+    return np.dtype({
+        'names': ['TimeStamp', 'PacketID', 'Class'],
+        'formats': ['<u4', '<u2', 'u1'],
+        'offsets': [0, 4, 6],
+        'itemsize': bytes_data_packet,
+    })
+
+
+class CacheHeader:
+    def __init__(self, source_size, source_mtime, bytes_headers, bytes_data_packet, n_data_packets,
+                 headers_hash, capacity=None, n_keys=0, version=CACHE_VERSION):
+        self.version = version
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.bytes_headers = bytes_headers
+        self.bytes_data_packet = bytes_data_packet
+        self.n_data_packets = n_data_packets
+        self.capacity = n_data_packets if capacity is None else capacity
+        self.headers_hash = headers_hash
+        self.n_keys = n_keys
+
+    @classmethod
+    def from_source(cls, filepath, bytes_headers, bytes_data_packet, n_data_packets):
+        stat = os.stat(filepath)
+        with open(filepath, 'rb') as fid:
+            headers_hash = hashlib.sha1(fid.read(bytes_headers)).digest()
+        return cls(stat.st_size, stat.st_mtime_ns, bytes_headers, bytes_data_packet, n_data_packets,
+                   headers_hash)
+
+    @classmethod
+    def read(cls, cache_file_name):
+        """Read the header of a cache file, returning None if it is not a valid cache file."""
+        try:
+            with open(cache_file_name, 'rb') as cache_id:
+                return cls.unpack(cache_id.read(CACHE_HEADER_SIZE))
+        except OSError:
+            return None
+
+    @classmethod
+    def unpack(cls, raw):
+        if len(raw) < CACHE_HEADER_SIZE:
+            return None
+
+        (magic, version, source_size, source_mtime, bytes_headers, bytes_data_packet,
+         n_data_packets, capacity, headers_hash, n_keys) = struct.unpack_from(CACHE_HEADER_FORMAT, raw)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        return cls(source_size, source_mtime, bytes_headers, bytes_data_packet, n_data_packets,
+                   headers_hash, capacity, n_keys, version)
+
+    def pack(self):
+        raw = struct.pack(CACHE_HEADER_FORMAT, CACHE_MAGIC, self.version, self.source_size,
+                          self.source_mtime, self.bytes_headers, self.bytes_data_packet,
+                          self.n_data_packets, self.capacity, self.headers_hash, self.n_keys)
+        return raw.ljust(CACHE_HEADER_SIZE, b'\x00')
+
+    def same_layout(self, other):
+        """True if both headers describe the same NEV headers and packet size."""
+        return (isinstance(other, CacheHeader) and self.version == other.version and
+                self.bytes_headers == other.bytes_headers and
+                self.bytes_data_packet == other.bytes_data_packet and
+                self.headers_hash == other.headers_hash)
+
+    def same_source(self, other):
+        """True if both headers describe the same NEV file, with the same packets."""
+        return (self.same_layout(other) and self.source_size == other.source_size and
+                self.source_mtime == other.source_mtime and
+                self.n_data_packets == other.n_data_packets)
+
+
+def cache_size(capacity, n_keys=0):
+    return CACHE_HEADER_SIZE + 7 * capacity + 12 * n_keys
+
+
+def column_offsets(capacity):
+    """File offset of each cache column."""
+    offsets = {}
+    offset = CACHE_HEADER_SIZE
+    for name, fmt in CACHE_FIELDS:
+        offsets[name] = offset
+        offset += np.dtype(fmt).itemsize * capacity
+    return offsets
+
+
+def is_writable_dir(path):
+    return os.path.isdir(path) and os.access(path, os.W_OK)
+
+
+def cache_file_path(filepath, cache_dir=None):
+    """Location of the cache file for a NEV file.
+
+    Without a cache directory the cache is kept next to the NEV file, as the MATLAB
+    reference does, unless that directory is read-only. Caches in a shared cache
+    directory are named after the NEV file and a hash of its absolute path.
+    """
+    path, name = os.path.split(os.path.abspath(filepath))
+    base_name = os.path.splitext(name)[0]
+
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if cache_dir is None:
+        if is_writable_dir(path):
+            return os.path.join(path, f"{base_name}.cache")
+        cache_dir = DEFAULT_CACHE_DIR
+
+    path_hash = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{base_name}-{path_hash}.cache")
+
+
+def is_shared_cache(cache_file_name, filepath):
+    return os.path.dirname(os.path.abspath(cache_file_name)) != os.path.dirname(os.path.abspath(filepath))
+
+
+@contextlib.contextmanager
+def locked(cache_id):
+    """Hold a shared advisory lock on an open cache file while reading it.
+
+    Updates hold an exclusive lock (see open_for_update) while they write the new
+    packets, key table and header, so readers in other threads or processes never see
+    them half written. Without fcntl (Windows) only the header-last write order and
+    the key count check remain.
+    """
+    if fcntl is None:
+        yield cache_id
+        return
+    fcntl.flock(cache_id.fileno(), fcntl.LOCK_SH)
+    try:
+        yield cache_id
+    finally:
+        fcntl.flock(cache_id.fileno(), fcntl.LOCK_UN)
+
+
+def open_for_update(cache_file_name):
+    """Open a cache file for reading and writing under an exclusive lock; None if there is none.
+
+    A cache renamed into place by a rebuild while waiting for the lock is opened again,
+    so updates always apply to the file the next reader will open. The lock is
+    released when the file is closed.
+    """
+    while True:
+        try:
+            cache_id = open(cache_file_name, 'r+b')
+        except OSError:
+            return None
+        if fcntl is None:
+            return cache_id
+        fcntl.flock(cache_id.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(cache_id.fileno()), os.stat(cache_file_name)):
+                return cache_id
+        except OSError:
+            pass
+        cache_id.close()
+
+
+def read_cache_state(cache_id):
+    """Header and key counts of an open cache file.
+
+    The key counts are None unless the file is complete and they add up to the number
+    of cached packets, which also rejects a key table rewritten by an append that was
+    interrupted before its header.
+    """
+    cache_id.seek(0)
+    cached = CacheHeader.unpack(cache_id.read(CACHE_HEADER_SIZE))
+    if cached is None or os.fstat(cache_id.fileno()).st_size != cache_size(cached.capacity, cached.n_keys):
+        return cached, None
+    cache_id.seek(cache_size(cached.capacity))
+    table = cache_id.read(12 * cached.n_keys)
+    keys = np.frombuffer(table, dtype='<u4', count=cached.n_keys)
+    counts = np.frombuffer(table, dtype='<u8', count=cached.n_keys, offset=4 * cached.n_keys)
+    if int(counts.sum()) != cached.n_data_packets:
+        return cached, None
+    return cached, (keys, counts.astype(np.int64))
+
+
+def read_cache(cache_file_name):
+    """(header, key counts) of a cache file, read through one open file; (None, None) if missing."""
+    try:
+        with open(cache_file_name, 'rb') as cache_id, locked(cache_id):
+            return read_cache_state(cache_id)
+    except OSError:
+        return None, None
+
+
+def read_key_counts(cache_file_name):
+    """Keys and packet counts stored in a cache file, or None if they are not consistent."""
+    return read_cache(cache_file_name)[1]
+
+
+def is_ahead_cache(filepath, cached, key_counts, header):
+    """True if a complete cache of the same recording holds more packets than header.
+
+    Another reader of a growing file (a follower, or an open that saw it later) may
+    have extended the cache past the packets header describes; its first packets are
+    still those of the file, as long as the file has not shrunk since. The file is
+    measured again, as it may have grown past header.source_size in the meantime.
+    """
+    return (key_counts is not None and cached.same_layout(header) and
+            cached.n_data_packets > header.n_data_packets and cached.source_size <= os.path.getsize(filepath))
+
+
+def write_key_counts(cache_id, header, keys, counts):
+    """Write the key table after the columns of an open cache file and set header.n_keys.
+
+    The header itself is not written.
+    """
+    header.n_keys = len(keys)
+    cache_id.seek(cache_size(header.capacity))
+    cache_id.write(np.asarray(keys, dtype='<u4').tobytes())
+    cache_id.write(np.asarray(counts, dtype='<u8').tobytes())
+    cache_id.truncate(cache_size(header.capacity, header.n_keys))
+
+
+def count_cache_keys(cache_id, header, start, stop):
+    """Count the keys of cached packets [start, stop) from the PacketID and Class columns.
+
+    cache_id is an open cache file (or its name).
+    """
+    if stop <= start:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64)
+    offsets = column_offsets(header.capacity)
+    packet_ids = np.memmap(cache_id, dtype='<u2', mode='r', offset=offsets['PacketID'] + 2 * start,
+                           shape=(stop - start,))
+    classes = np.memmap(cache_id, dtype='u1', mode='r', offset=offsets['Class'] + start,
+                        shape=(stop - start,))
+    return count_keys(packet_ids, classes)
+
+
+def fill_nev_cache(filepath, cache_id, header, start, stop, chunk_packets=1 << 20):
+    """Copy the TimeStamp, PacketID and Class of packets [start, stop) into the cache columns.
+
+    cache_id is a cache file (or its name) open for reading and writing.
+
+    The packet headers are read in a single pass through a memory-mapped view strided by
+    the packet size, so the work per packet is done by NumPy rather than the interpreter.
+    """
+    if stop <= start:
+        return
+    packets = np.memmap(filepath, dtype=nev_packet_dtype(header.bytes_data_packet), mode='r',
+                        offset=header.bytes_headers + start * header.bytes_data_packet,
+                        shape=(stop - start,))
+    offsets = column_offsets(header.capacity)
+    for name, fmt in CACHE_FIELDS:
+        column = np.memmap(cache_id, dtype=fmt, mode='r+',
+                           offset=offsets[name] + start * np.dtype(fmt).itemsize, shape=(stop - start,))
+        for a in range(0, stop - start, chunk_packets):
+            b = min(a + chunk_packets, stop - start)
+            column[a:b] = packets[name][a:b]
+        column.flush()
+        del column
+    del packets
+
+
+def create_temp_file(cache_dir):
+    """Create a new, empty temporary cache file in cache_dir; returns (fd, file name).
+
+    The file is created with mode 0o666 so the kernel applies the umask, giving the
+    cache the mode of a regular file that other users of the directory can read.
+    """
+    flags = os.O_CREAT | os.O_EXCL | os.O_RDWR | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp_file_name = os.path.join(cache_dir, f'.{os.urandom(6).hex()}.cache.tmp')
+        try:
+            return os.open(tmp_file_name, flags, 0o666), tmp_file_name
+        except FileExistsError:
+            continue
+
+
+def write_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets,
+                    chunk_packets=1 << 20, header=None, capacity=None):
+    """Write the TimeStamp, PacketID and Class columns of a NEV file to a cache file.
+
+    The cache is written to a temporary file and renamed into place, so readers never see
+    a partially written cache. capacity reserves room for packets appended later.
+    """
+    if header is None:
+        header = CacheHeader.from_source(filepath, bytes_headers, bytes_data_packet, n_data_packets)
+    header.capacity = max(capacity or 0, n_data_packets)
+
+    cache_dir = os.path.dirname(os.path.abspath(cache_file_name))
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file_name = create_temp_file(cache_dir)
+    try:
+        with os.fdopen(fd, 'r+b') as cache_id:
+            cache_id.write(header.pack())
+            cache_id.truncate(cache_size(header.capacity))
+            fill_nev_cache(filepath, cache_id, header, 0, n_data_packets, chunk_packets)
+            keys, counts = count_cache_keys(cache_id, header, 0, n_data_packets)
+            write_key_counts(cache_id, header, keys, counts)
+            cache_id.seek(0)
+            cache_id.write(header.pack())
+        os.replace(tmp_file_name, cache_file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+
+def extend_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets):
+    """Bring the cache of a NEV file that has grown up to date by appending the new packets.
+
+    Only packets beyond those already cached are read. When the cache has no room left
+    it is rebuilt with room for as many packets again, so appends stay cheap on
+    average. A cache that does not belong to the same recording is rebuilt from
+    scratch. Returns True if the packets were appended in place, False if the cache
+    was rebuilt.
+    """
+    header = CacheHeader.from_source(filepath, bytes_headers, bytes_data_packet, n_data_packets)
+    cache_id = open_for_update(cache_file_name)
+    if cache_id is None:
+        write_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets,
+                        header=header, capacity=2 * n_data_packets)
+        return False
+
+    # The cache is re-read and updated through this one open file, under its lock, so
+    # neither a concurrent append nor a rebuild renamed into place can mix its packets
+    # or key table with these
+    with cache_id:
+        cached, key_counts = read_cache_state(cache_id)
+        if is_ahead_cache(filepath, cached, key_counts, header):
+            return True
+        if (key_counts is None or not cached.same_layout(header) or cached.n_data_packets > n_data_packets or
+                n_data_packets > cached.capacity):
+            # Rebuilt while the lock is held; updates waiting for it then reopen the new file
+            write_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets,
+                            header=header, capacity=2 * n_data_packets)
+            return False
+
+        # Write the new packets and key counts first and the header last: a cache
+        # interrupted in between still describes its old contents, or fails validation
+        # and is rebuilt
+        header.capacity = cached.capacity
+        fill_nev_cache(filepath, cache_id, header, cached.n_data_packets, n_data_packets)
+        new_keys, new_counts = count_cache_keys(cache_id, header, cached.n_data_packets, n_data_packets)
+        keys = np.union1d(key_counts[0], new_keys)
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[np.searchsorted(keys, key_counts[0])] += key_counts[1]
+        counts[np.searchsorted(keys, new_keys)] += new_counts
+        write_key_counts(cache_id, header, keys, counts)
+        cache_id.seek(0)
+        cache_id.write(header.pack())
+    return True
+
+
+def evict_cache(cache_dir, max_bytes=None, keep=()):
+    """Remove the least recently used cache files until the directory fits in max_bytes."""
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith('.cache'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    keep = {os.path.abspath(path) for path in keep}
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def open_nev_cache(filepath, bytes_headers, bytes_data_packet, n_data_packets, cache_dir=None,
+                   max_bytes=None, stats=None):
+    """Return the name of an up-to-date cache file for a NEV file, building it if needed.
+
+    A cache of the same recording that holds fewer packets (the file has grown since,
+    e.g. while it is being recorded or followed) is extended with the new packets
+    rather than rebuilt. If stats (an OpenStats) is given, the cache outcome ('hit',
+    'extend' or 'miss') and the bytes read are recorded; a cache that only needed its
+    header refreshed (no new complete packets) counts as a hit.
+    """
+    cache_file_name = cache_file_path(filepath, cache_dir)
+    header = CacheHeader.from_source(filepath, bytes_headers, bytes_data_packet, n_data_packets)
+
+    outcome, n_read = 'hit', 0
+    cached, key_counts = read_cache(cache_file_name)
+    if key_counts is None or not cached.same_source(header):
+        # A cache extended past this open by another reader of the growing file is a hit
+        # too; only its first n_data_packets packets are used
+        if not is_ahead_cache(filepath, cached, key_counts, header):
+            outcome, n_read = 'miss', n_data_packets
+            if cached is not None and cached.same_layout(header) and cached.n_data_packets <= n_data_packets:
+                # extend_nev_cache still rebuilds the cache when it has no room left
+                if extend_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet,
+                                    n_data_packets):
+                    # A file that only gained part of a packet keeps its cache as it is
+                    n_read = n_data_packets - cached.n_data_packets
+                    outcome = 'extend' if n_read else 'hit'
+            else:
+                write_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_data_packets,
+                                header=header)
+
+    if stats is not None:
+        # Headers hashed for validation, the cache header, and the packets read into the cache
+        stats.cache = outcome
+        stats.bytes_read += bytes_headers + CACHE_HEADER_SIZE + n_read * bytes_data_packet
+
+    if is_shared_cache(cache_file_name, filepath):
+        # Mark the cache as recently used, then keep the shared directory within bounds
+        os.utime(cache_file_name)
+        evict_cache(os.path.dirname(cache_file_name), max_bytes, keep=(cache_file_name,))
+
+    return cache_file_name
+
+
+class MemoryMap:
+    """Read-only view of the NEV cache file.
+
+    Exposes the TimeStamp, PacketID and Class columns as memory-mapped arrays without
+    copying them into memory. The mapping stays open for as long as the handle does.
+    """
+    fields = CACHE_FIELDS
+
+    def __init__(self, cache_file_name, n_data_packets):
+        self.cache_file_name = cache_file_name
+        self.n_data_packets = n_data_packets
+        self.dtype = np.dtype(list(self.fields))
+        self.columns = {}
+        # The header and the columns are read through one open file, so a cache replaced
+        # by a rebuild in between is never mapped with the capacity of the other file
+        with open(cache_file_name, 'rb') as cache_id:
+            with locked(cache_id):
+                cached = CacheHeader.unpack(cache_id.read(CACHE_HEADER_SIZE))
+            if cached is None or cached.n_data_packets < n_data_packets:
+                raise OSError(f"{cache_file_name} does not hold {n_data_packets} packets")
+            offsets = column_offsets(cached.capacity)
+            for name, fmt in self.fields:
+                self.columns[name] = np.memmap(cache_id, dtype=fmt, mode='r', offset=offsets[name],
+                                               shape=(n_data_packets,))
+
+    def __len__(self):
+        return self.n_data_packets
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+
+        # Rows are gathered into a (small) structured array
+        rows = np.empty(np.shape(self.columns['TimeStamp'][key]), dtype=self.dtype)
+        for name, _ in self.fields:
+            rows[name] = self.columns[name][key]
+        return rows
+
+    def close(self):
+        # The underlying mmap is released once no views of the columns remain
+        self.columns = {}
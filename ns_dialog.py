@@ -0,0 +1,31 @@
+import os
+import tkinter as tk
+from tkinter.filedialog import askopenfilename
+from ns_openfile import is_valid_file
+
+# File selection dialog used by ns_openfile when no file is given. Kept out of the core
+# modules so that reading files does not import tkinter, which is slow to import and
+# missing from many headless Python installs.
+
+
+def file_dialog():
+    root = tk.Tk()
+    root.withdraw()  # Hide the main window
+
+    selected_file = askopenfilename(
+        initialdir=os.getcwd(),
+        title="Select a NEV or NS* file",
+        filetypes=(("NEV and NS* files",
+                   "*.nev *.ns1 *.ns2 *.ns3 *.ns4 *.ns5 *.ns6"), ("All files", "*.*"))
+    )
+
+    if selected_file and is_valid_file(selected_file):
+        print("\nSelected file:")
+        print(f"- {selected_file}")
+        valid_file = selected_file
+    else:
+        print("No valid file selected")
+        valid_file = None
+
+    root.destroy()
+    return valid_file
@@ -0,0 +1,86 @@
+import numpy as np
+
+# Digital inputs of a NEV file. Digital events are the packets with PacketID 0; bit j
+# of their Class (insertion reason) tells which input changed, and the payload holds
+# the state of every input after the change: the 16 bit parallel port word at byte 8
+# and the levels of SMA inputs 1-4 at bytes 10-16.
+
+DIGITAL_INPUTS = ('Parallel Input', 'SMA 1', 'SMA 2', 'SMA 3', 'SMA 4')
+
+
+def digital_dtype(bytes_data_packet):
+    """Structured dtype of a NEV digital event packet."""
+    return np.dtype({
+        'names': ['TimeStamp', 'PacketID', 'Class', 'Parallel', 'SMA'],
+        'formats': ['<u4', '<u2', 'u1', '<u2', ('<u2', (4,))],
+        'offsets': [0, 4, 6, 8, 10],
+        'itemsize': bytes_data_packet,
+    })
+
+
+def get_digital_events(hfile):
+    """Read every digital event of the NEV file in one operation.
+
+    Returns (ns_result, events) where events maps Index (packet number), TimeStamp,
+    Class, Parallel (the parallel port word after the event) and SMA ((n_events, 4)
+    levels of the SMA inputs after the event) to arrays in file order.
+    """
+    file_info = hfile.get_file_info('NEURALEV')
+    if file_info is None or file_info.event_index is None:
+        return 'ns_BADFILE', None
+
+    indices = file_info.event_index.packet_indices(0)
+    packets = np.memmap(file_info.file_name, dtype=digital_dtype(file_info.bytes_data_packet), mode='r',
+                        offset=file_info.bytes_headers, shape=(len(file_info.memory_map),))[indices]
+
+    return 'ns_OK', {
+        'Index': indices,
+        'TimeStamp': packets['TimeStamp'],
+        'Class': packets['Class'],
+        'Parallel': packets['Parallel'],
+        'SMA': packets['SMA'],
+    }
+
+
+def digital_input_index(digital_input):
+    if isinstance(digital_input, str):
+        return DIGITAL_INPUTS.index(digital_input) if digital_input in DIGITAL_INPUTS else None
+    return int(digital_input) if 0 <= digital_input < len(DIGITAL_INPUTS) else None
+
+
+def get_digital_edges(hfile, digital_input, bit=None, events=None):
+    """Rising and falling edge timestamps of one digital input.
+
+    digital_input is 'Parallel Input', 'SMA 1' ... 'SMA 4' or its class bit (0-4).
+    Edges are classified from the input state recorded in each event rather than by
+    alternating rising/falling, so a dropped event does not swap the edges that follow
+    it. For the parallel port, an edge is a change of bit (0-15) of the word, or of any
+    bit when bit is None; the port is assumed to be 0 before its first event. events
+    may be passed from get_digital_events to decode several inputs with one read.
+
+    Returns (ns_result, edges) where edges maps Rising and Falling to timestamps.
+    """
+    j = digital_input_index(digital_input)
+    if j is None:
+        return 'ns_BADENTITY', None
+    if bit is not None and not 0 <= bit < 16:
+        return 'ns_BADINDEX', None
+    if events is None:
+        ns_result, events = get_digital_events(hfile)
+        if ns_result != 'ns_OK':
+            return ns_result, None
+
+    changed = (events['Class'] & (1 << j)) != 0
+    times = events['TimeStamp'][changed]
+
+    if j == 0:
+        mask = 0xFFFF if bit is None else 1 << bit
+        words = events['Parallel'][changed]
+        previous = np.concatenate(([0], words[:-1])).astype(words.dtype)
+        rising = (words & ~previous & mask) != 0
+        falling = (previous & ~words & mask) != 0
+    else:
+        rising = events['SMA'][changed, j - 1] != 0
+        falling = ~rising
+
+    return 'ns_OK', {'Rising': times[rising], 'Falling': times[falling]}
@@ -0,0 +1,239 @@
+import threading
+import numpy as np
+
+
+def count_keys(packet_ids, classes, chunk_packets=1 << 20):
+    """Number of packets of every PacketID << 8 | Class key, in bounded memory.
+
+    Packet IDs are counted first, so the (PacketID, Class) pairs of the second pass can
+    be counted with bincount over a dense table of present IDs x 256 classes. Only one
+    chunk of the columns is held in memory at a time. Returns (keys, counts) with the
+    keys in ascending order.
+    """
+    n = len(packet_ids)
+    present = np.zeros(1 << 16, dtype=bool)
+    for a in range(0, n, chunk_packets):
+        present |= np.bincount(packet_ids[a:a + chunk_packets], minlength=1 << 16) > 0
+
+    ids = np.flatnonzero(present)
+    dense = np.zeros(1 << 16, dtype=np.int64)
+    dense[ids] = np.arange(len(ids))
+    table = np.zeros(len(ids) * 256, dtype=np.int64)
+    for a in range(0, n, chunk_packets):
+        b = min(a + chunk_packets, n)
+        table += np.bincount((dense[packet_ids[a:b]] << 8) | classes[a:b], minlength=len(table))
+
+    nonzero = np.flatnonzero(table)
+    keys = ((ids[nonzero >> 8] << 8) | (nonzero & 0xFF)).astype(np.uint32)
+    return keys, table[nonzero]
+
+
+class EventIndex:
+    """Per-electrode index of the NEV data packets.
+
+    keys holds the PacketID << 8 | Class values present in the file and offsets the
+    start of the packets of each key in order (CSR layout), where order lists the
+    packets stably sorted by key. The packets of one electrode and class thus form a
+    contiguous run that stays in timestamp order, so looking up the events of an
+    electrode costs O(log n_keys + k) instead of a scan over every packet.
+
+    The counts (keys and offsets) are all that opening a file needs; they are taken
+    from the cache or counted in bounded memory. order (4 bytes per packet) is only
+    built by a chunked counting sort on the first per-electrode lookup.
+    """
+
+    def __init__(self, timestamps, packet_ids, classes, keys=None, counts=None, chunk_packets=1 << 20):
+        self.timestamps = timestamps
+        self.packet_ids_column = packet_ids
+        self.classes_column = classes
+        self.chunk_packets = chunk_packets
+        if keys is None or counts is None:
+            keys, counts = count_keys(packet_ids, classes, chunk_packets)
+        self.keys = np.asarray(keys, dtype=np.uint32)
+        self.offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        self._order = None
+        self.lock = threading.Lock()
+
+    @property
+    def order(self):
+        if self._order is None:
+            with self.lock:
+                if self._order is None:
+                    self._order = self.sort_packets()
+        return self._order
+
+    def sort_packets(self):
+        """Packet numbers stably sorted by key, built one chunk at a time.
+
+        Each chunk is sorted on its own and its packets are placed after those of the
+        same key in the previous chunks, which keeps every run in file order.
+        """
+        n = int(self.offsets[-1])
+        order = np.empty(n, dtype=np.uint32 if n < 2 ** 32 else np.int64)
+        cursor = self.offsets[:-1].copy()
+
+        # Rank of every key through a dense (packet ID, class) table rather than a binary
+        # search per packet; 16 bit ranks let argsort use a radix sort
+        ids = np.unique(self.keys >> 8)
+        dense = np.zeros(1 << 16, dtype=np.int64)
+        dense[ids] = np.arange(len(ids))
+        rank_table = np.zeros(len(ids) * 256, dtype=np.uint16 if len(self.keys) <= 1 << 16 else np.int64)
+        rank_table[(dense[self.keys >> 8] << 8) | (self.keys & 0xFF)] = np.arange(len(self.keys))
+
+        for a in range(0, n, self.chunk_packets):
+            b = min(a + self.chunk_packets, n)
+            rank = rank_table[(dense[self.packet_ids_column[a:b]] << 8) | self.classes_column[a:b]]
+            chunk_order = np.argsort(rank, kind='stable')
+            sorted_rank = rank[chunk_order]
+            chunk_counts = np.bincount(rank, minlength=len(self.keys))
+
+            # Each packet goes to the cursor of its key plus its rank among the chunk's
+            # packets of that key
+            run_starts = np.cumsum(chunk_counts) - chunk_counts
+            order[cursor[sorted_rank] + np.arange(b - a) - run_starts[sorted_rank]] = chunk_order + a
+            cursor += chunk_counts
+        return order
+
+    @property
+    def packet_ids(self):
+        return (self.keys >> 8).astype(np.uint16)
+
+    @property
+    def classes(self):
+        return (self.keys & 0xFF).astype(np.uint8)
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def runs(self, packet_id, reason=None):
+        """Range of keys (first, last) belonging to packet_id and, if given, reason."""
+        packet_id = int(packet_id)
+        if reason is None:
+            lo, hi = packet_id << 8, (packet_id + 1) << 8
+        else:
+            lo = (packet_id << 8) | int(reason)
+            hi = lo + 1
+        return np.searchsorted(self.keys, lo), np.searchsorted(self.keys, hi)
+
+    def count(self, packet_id, reason=None):
+        first, last = self.runs(packet_id, reason)
+        return int(self.offsets[last] - self.offsets[first])
+
+    def count_many(self, packet_ids, reasons=None):
+        """Vectorized count: packet_ids and reasons are broadcast against each other."""
+        packet_ids = np.asarray(packet_ids, dtype=np.int64)
+        if reasons is None:
+            lo, hi = packet_ids << 8, (packet_ids + 1) << 8
+        else:
+            lo = (packet_ids << 8) | np.asarray(reasons, dtype=np.int64)
+            hi = lo + 1
+        return self.offsets[np.searchsorted(self.keys, hi)] - self.offsets[np.searchsorted(self.keys, lo)]
+
+    def packet_indices(self, packet_id, reason=None):
+        """Indices of the matching packets in the NEV file, in timestamp order."""
+        first, last = self.runs(packet_id, reason)
+        indices = self.order[self.offsets[first]:self.offsets[last]]
+        if last - first > 1:
+            indices = np.sort(indices)
+        return indices
+
+    def times(self, packet_id, reason=None):
+        """Timestamps of the matching packets, in file order."""
+        return self.timestamps[self.packet_indices(packet_id, reason)]
+
+
+def get_event_times(hfile, electrode_id, reason=None):
+    """Timestamps of the events of one electrode (PacketID), optionally of one class.
+
+    Returns (ns_result, times) with times in units of the NEV time resolution.
+    """
+    file_info = hfile.get_file_info('NEURALEV')
+    if file_info is None or file_info.event_index is None:
+        return 'ns_BADFILE', None
+
+    return 'ns_OK', file_info.event_index.times(electrode_id, reason)
+
+
+def timestamp_epochs(timestamps):
+    """Start of each run of non-decreasing timestamps.
+
+    NEV timestamps are stored in time order, but the 32-bit counter can wrap (or the
+    clock be reset) during a long recording. Events in epoch k are addressed as
+    TimeStamp + k * 2**32, which makes time monotonic over the whole file.
+    """
+    timestamps = np.asarray(timestamps)
+    return np.append(0, np.flatnonzero(timestamps[1:] < timestamps[:-1]) + 1).astype(np.int64)
+
+
+def search_timestamps(file_info, times):
+    """Index of the first packet at or after each (unwrapped) time, in file order."""
+    timestamps = file_info.memory_map['TimeStamp']
+    if file_info.epoch_starts is None:
+        file_info.epoch_starts = timestamp_epochs(timestamps)
+    starts = np.append(file_info.epoch_starts, len(timestamps))
+
+    times = np.asarray(times, dtype=np.int64)
+    epoch = times >> 32
+    positions = np.where(epoch < 0, 0, len(timestamps)).astype(np.int64)
+    for k in range(len(starts) - 1):
+        in_epoch = epoch == k
+        if np.any(in_epoch):
+            a, b = starts[k], starts[k + 1]
+            positions[in_epoch] = a + np.searchsorted(timestamps[a:b], times[in_epoch] & 0xFFFFFFFF)
+    return positions
+
+
+def select_events(events, electrodes=None, classes=None):
+    if electrodes is None and classes is None:
+        return events
+    mask = np.ones(len(events['TimeStamp']), dtype=bool)
+    if electrodes is not None:
+        mask &= np.isin(events['PacketID'], electrodes)
+    if classes is not None:
+        mask &= np.isin(events['Class'], classes)
+    return {name: column[mask] for name, column in events.items()}
+
+
+def get_events_in_window(hfile, t0, t1, electrodes=None, classes=None):
+    """Events with t0 <= TimeStamp < t1, optionally restricted to electrodes and classes.
+
+    Returns (ns_result, events) where events maps TimeStamp, PacketID and Class to
+    arrays. Without filters these are zero-copy slices of the memory map.
+    """
+    file_info = hfile.get_file_info('NEURALEV')
+    if file_info is None or file_info.memory_map is None:
+        return 'ns_BADFILE', None
+
+    a, b = search_timestamps(file_info, [t0, t1])
+    b = max(a, b)
+    events = {name: file_info.memory_map[name][a:b] for name in ('TimeStamp', 'PacketID', 'Class')}
+    return 'ns_OK', select_events(events, electrodes, classes)
+
+
+def get_events_in_windows(hfile, t0, t1, electrodes=None, classes=None):
+    """Batched get_events_in_window over many windows, e.g. one per trial.
+
+    Returns (ns_result, events) where events holds the TimeStamp, PacketID and Class of
+    all windows concatenated, the Window each event belongs to, and Offsets such that
+    window i is events[...][Offsets[i]:Offsets[i + 1]]. Windows may overlap.
+    """
+    file_info = hfile.get_file_info('NEURALEV')
+    if file_info is None or file_info.memory_map is None:
+        return 'ns_BADFILE', None
+
+    t0 = np.atleast_1d(np.asarray(t0, dtype=np.int64))
+    t1 = np.broadcast_to(np.asarray(t1, dtype=np.int64), t0.shape)
+    starts = search_timestamps(file_info, t0)
+    lengths = np.maximum(search_timestamps(file_info, t1) - starts, 0)
+
+    # Gather all windows with one index array instead of a loop over windows
+    window = np.repeat(np.arange(len(t0)), lengths)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    indices = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lengths)
+
+    events = {name: file_info.memory_map[name][indices] for name in ('TimeStamp', 'PacketID', 'Class')}
+    events['Window'] = window
+    events = select_events(events, electrodes, classes)
+    events['Offsets'] = np.concatenate(([0], np.cumsum(np.bincount(events['Window'], minlength=len(t0)))))
+    return 'ns_OK', events
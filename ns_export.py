@@ -0,0 +1,256 @@
+import json
+import os
+import numpy as np
+from ns_analog import iter_analog_chunks
+from ns_segment import waveform_view
+
+# Export of NEV event tables and NSx samples to columnar files, so that analyses can
+# read only the columns they need instead of parsing the Ripple files again. Parquet
+# and Arrow IPC files are written with pyarrow, HDF5 files with h5py; both are
+# optional and only imported when used. Data is streamed in batches of bounded size.
+
+EXPORT_FORMATS = {
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.h5': 'hdf5',
+    '.hdf5': 'hdf5',
+}
+
+# Arrow IPC files are left uncompressed by default so they can be memory mapped
+DEFAULT_COMPRESSION = {'parquet': 'zstd', 'arrow': None, 'hdf5': 'gzip'}
+
+
+def export_format(filename, format=None):
+    if format is None:
+        format = EXPORT_FORMATS.get(os.path.splitext(filename)[1].lower())
+    if format not in DEFAULT_COMPRESSION:
+        raise ValueError(f"Unknown export format for {filename}: use one of {', '.join(DEFAULT_COMPRESSION)}")
+    return format
+
+
+def import_optional(module, format):
+    try:
+        return __import__(module, fromlist=['_'])
+    except ImportError as error:
+        package = module.split('.')[0]
+        raise ImportError(f"Exporting to {format} needs {package}: pip install {package}") from error
+
+
+class ArrowWriter:
+    """Writes batches of columns to a Parquet file (one row group per batch) or an Arrow IPC file."""
+
+    def __init__(self, filename, fields, metadata, format, compression):
+        self.pa = pa = import_optional('pyarrow', format)
+        # Waveforms (2-D columns) are stored as fixed size lists
+        types = {name: pa.from_numpy_dtype(dtype) for name, (dtype, _) in fields.items()}
+        schema = pa.schema([
+            pa.field(name, pa.list_(types[name], shape[0]) if shape else types[name])
+            for name, (_, shape) in fields.items()
+        ], metadata={'ns_export': json.dumps(metadata)})
+        self.schema = schema
+
+        if format == 'parquet':
+            parquet = import_optional('pyarrow.parquet', format)
+            self.writer = parquet.ParquetWriter(filename, schema, compression=compression or 'none')
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            self.writer = pa.ipc.new_file(filename, schema, options=options)
+
+    def write(self, columns):
+        pa = self.pa
+        arrays = []
+        for field in self.schema:
+            column = np.ascontiguousarray(columns[field.name])
+            if column.ndim == 2:
+                arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(column.ravel()), column.shape[1]))
+            else:
+                arrays.append(pa.array(column))
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if isinstance(self.writer, pa.ipc.RecordBatchFileWriter):
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write_table(pa.Table.from_batches([batch]))
+
+    def close(self):
+        self.writer.close()
+
+
+class HDF5Writer:
+    """Writes batches of columns to chunked, compressed HDF5 datasets of known length."""
+
+    def __init__(self, filename, fields, metadata, n_rows, compression, chunk_rows):
+        h5py = import_optional('h5py', 'hdf5')
+        self.file = h5py.File(filename, 'w')
+        self.position = 0
+        try:
+            self.file.attrs['ns_export'] = json.dumps(metadata)
+            for name, (dtype, shape) in fields.items():
+                # Empty datasets cannot be chunked (or compressed); they are stored contiguous
+                options = {}
+                if n_rows:
+                    options = {'chunks': (min(chunk_rows, n_rows),) + shape, 'compression': compression}
+                self.file.create_dataset(name, shape=(n_rows,) + shape, dtype=dtype, **options)
+        except BaseException:
+            self.file.close()
+            raise
+
+    def write(self, columns):
+        n = 0
+        for name, column in columns.items():
+            self.file[name][self.position:self.position + len(column)] = column
+            n = len(column)
+        self.position += n
+
+    def close(self):
+        self.file.close()
+
+
+def open_writer(filename, format, fields, metadata, n_rows, compression, chunk_rows):
+    if compression == 'default':
+        compression = DEFAULT_COMPRESSION[format]
+    if format == 'hdf5':
+        return HDF5Writer(filename, fields, metadata, n_rows, compression, chunk_rows)
+    return ArrowWriter(filename, fields, metadata, format, compression)
+
+
+def write_batches(filename, format, fields, metadata, n_rows, batches, compression, chunk_rows):
+    # Written to a temporary file first so a failed export leaves no partial file behind
+    tmp_filename = f"{filename}.tmp"
+    writer = None
+    try:
+        writer = open_writer(tmp_filename, format, fields, metadata, n_rows, compression, chunk_rows)
+        for columns in batches:
+            writer.write(columns)
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+
+def entity_metadata(entity):
+    return {
+        'electrode_id': int(entity.electrode_id or 0),
+        'label': entity.label,
+        'scale': None if entity.scale is None else float(entity.scale),
+        'units': entity.units,
+    }
+
+
+def export_nev(hfile, filename, format=None, waveforms=False, batch_packets=1000000, compression='default'):
+    """Export the event table of the NEV file of hfile.
+
+    Columns are TimeStamp, PacketID and Class, plus Waveform (the raw samples of each
+    packet as a fixed size list) when waveforms=True. format is 'parquet', 'arrow' or
+    'hdf5' and is taken from the file extension when None. Packets are copied from the
+    memory-mapped cache batch_packets at a time, so memory use does not depend on the
+    size of the file. compression is passed to the writer ('zstd' for Parquet, none for
+    Arrow IPC, 'gzip' for HDF5 by default).
+
+    Returns ns_result.
+    """
+    format = export_format(filename, format)
+    file_info = hfile.get_file_info('NEURALEV')
+    if file_info is None:
+        return 'ns_BADFILE'
+
+    data = file_info.memory_map
+    n_data_packets = 0 if data is None else len(data)
+    fields = {
+        'TimeStamp': (np.dtype('<u4'), ()),
+        'PacketID': (np.dtype('<u2'), ()),
+        'Class': (np.dtype('u1'), ()),
+    }
+
+    waveform_data = None
+    if waveforms and n_data_packets:
+        # Packets of all electrodes share one layout; use the sample size of the first Segment
+        segments = [e for e in file_info.entity if e.entity_type == 'Segment']
+        bytes_per_waveform = segments[0].bytes_per_waveform if segments else 2
+        waveform_data = waveform_view(file_info, bytes_per_waveform)
+        fields['Waveform'] = (waveform_data.dtype, waveform_data.shape[1:])
+
+    metadata = {
+        'source': os.path.abspath(file_info.file_name),
+        'file_type_id': file_info.file_type_id,
+        'bytes_data_packet': file_info.bytes_data_packet,
+        'entity': [dict(entity_metadata(e), entity_type=e.entity_type) for e in file_info.entity],
+    }
+
+    def batches():
+        for start in range(0, n_data_packets, batch_packets):
+            stop = min(start + batch_packets, n_data_packets)
+            columns = {name: data[name][start:stop] for name in ('TimeStamp', 'PacketID', 'Class')}
+            if waveform_data is not None:
+                columns['Waveform'] = waveform_data[start:stop]
+            yield columns
+
+    write_batches(filename, format, fields, metadata, n_data_packets, batches(), compression, batch_packets)
+    return 'ns_OK'
+
+
+def column_names(entities):
+    """One column name per entity: its label, or elec<id> when labels are missing or repeated."""
+    labels = [e.label for e in entities]
+    names = []
+    for entity, label in zip(entities, labels):
+        name = label if label and labels.count(label) == 1 else f"elec{entity.electrode_id}"
+        names.append(name.replace('/', '_'))
+    return names
+
+
+def export_nsx(hfile, filename, entities=None, format=None, scale=False, batch_points=100000,
+               compression='default'):
+    """Export the samples of Analog entities of one NSx file.
+
+    entities is a list of Analog entities (or indices into hfile.entity), by default all
+    channels of hfile.file_info. Each channel becomes a column named after its label,
+    next to a TimeStamp column with the timestamp of every sample. Samples are exported
+    raw (int16 or float32) unless scale=True; scales, units and the data block layout
+    are stored in the file metadata. Data is streamed batch_points samples at a time.
+
+    Returns ns_result.
+    """
+    format = export_format(filename, format)
+    if entities is None:
+        entities = []
+        if hfile.file_info is not None:
+            # The data pass of a lazy handle drops the channels without samples
+            hfile.file_info.load_counts()
+            entities = [e for e in hfile.file_info.entity if e.entity_type == 'Analog']
+    entities = [hfile.get_entity(e) for e in entities]
+
+    ns_result, chunks = iter_analog_chunks(hfile, entities, batch_points, scale=scale)
+    if ns_result != 'ns_OK':
+        return ns_result
+
+    file_info = entities[0].file_info
+    names = column_names(entities)
+    sample_dtype = np.dtype('<f4') if scale else file_info.sample_dtype
+    fields = {'TimeStamp': (np.dtype('<u8'), ())}
+    fields.update((name, (sample_dtype, ())) for name in names)
+
+    metadata = {
+        'source': os.path.abspath(file_info.file_name),
+        'file_type_id': file_info.file_type_id,
+        'period': file_info.period,
+        'scaled': scale,
+        'blocks': [{'TimeStamp': int(block['TimeStamp']), 'NumPoints': int(block['NumPoints'])}
+                   for block in file_info.blocks],
+        'channels': {name: entity_metadata(e) for name, e in zip(names, entities)},
+    }
+
+    def batches():
+        for chunk in chunks:
+            offsets = np.arange(len(chunk['Data']), dtype=np.uint64) * np.uint64(chunk['Period'])
+            columns = {'TimeStamp': np.uint64(chunk['TimeStamp']) + offsets}
+            columns.update((name, chunk['Data'][:, i]) for i, name in enumerate(names))
+            yield columns
+
+    n_points = int(file_info.blocks['NumPoints'].sum())
+    write_batches(filename, format, fields, metadata, n_points, batches(), compression, batch_points)
+    return 'ns_OK'
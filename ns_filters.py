@@ -0,0 +1,94 @@
+import numpy as np
+
+# Stateful FIR stages for streaming analog data through iter_analog_chunks. Each stage
+# filters (n_points, n_channels) chunks and carries its state over to the next chunk,
+# so a recording filtered chunk by chunk gives the same result as filtering it whole.
+# Stages expose factor (input samples per output sample) and delay (group delay, in
+# input samples) so output timestamps can be corrected.
+
+
+def lowpass_taps(cutoff, n_taps):
+    """Hamming-windowed sinc lowpass; cutoff is in cycles per sample (0 to 0.5)."""
+    n = np.arange(n_taps) - (n_taps - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(n_taps)
+    return taps / taps.sum()
+
+
+def bandpass_taps(low, high, n_taps):
+    """Windowed sinc bandpass between low and high, in cycles per sample."""
+    n = np.arange(n_taps) - (n_taps - 1) / 2
+    taps = (2 * high * np.sinc(2 * high * n) - 2 * low * np.sinc(2 * low * n)) * np.hamming(n_taps)
+
+    # Normalise to unit gain at the centre of the pass band
+    centre = (low + high) / 2
+    return taps / np.abs(np.sum(taps * np.exp(-2j * np.pi * centre * np.arange(n_taps))))
+
+
+class FIRFilter:
+    """Linear-phase FIR filter applied along the time axis with FFT convolution."""
+    factor = 1
+
+    def __init__(self, taps):
+        self.taps = np.asarray(taps, dtype=np.float64)
+        if len(self.taps) % 2 == 0:
+            raise ValueError("FIR filters need an odd number of taps")
+        self.delay = (len(self.taps) - 1) // 2
+        self.state = None
+
+    def reset(self):
+        self.state = None
+
+    def __call__(self, x):
+        n_taps = len(self.taps)
+        if self.state is None:
+            self.state = np.zeros((n_taps - 1, x.shape[1]))
+        extended = np.concatenate((self.state, x))
+        self.state = extended[len(extended) - (n_taps - 1):]
+
+        # Valid part of the convolution: one output per input sample
+        n_fft = 1 << int(np.ceil(np.log2(len(extended) + n_taps - 1)))
+        spectrum = np.fft.rfft(extended, n_fft, axis=0) * np.fft.rfft(self.taps, n_fft)[:, None]
+        return np.fft.irfft(spectrum, n_fft, axis=0)[n_taps - 1:len(extended)]
+
+
+class BandpassFilter(FIRFilter):
+    """Bandpass between low and high Hz for data sampled at sampling_rate Hz.
+
+    The taps span about four periods of the low corner by default, so low corners of
+    a few Hz need many taps at full sampling rates; decimate the data first (e.g.
+    [Decimator(30), BandpassFilter(1, 250, 1000)] at 30 kHz). n_taps too short to
+    resolve the low corner raise ValueError instead of giving a lowpass.
+    """
+
+    def __init__(self, low, high, sampling_rate, n_taps=None):
+        if not 0 < low < high < sampling_rate / 2:
+            raise ValueError(f"corner frequencies must satisfy 0 < low < high < {sampling_rate / 2:g} Hz, "
+                             f"got {low:g} and {high:g} Hz")
+        # The transition band of a Hamming window is about 3.3 / n_taps cycles per sample
+        min_taps = int(np.ceil(3.3 * sampling_rate / low)) | 1
+        if n_taps is None:
+            n_taps = max(int(4 * sampling_rate / low) | 1, min_taps)
+        elif n_taps < min_taps:
+            raise ValueError(f"{n_taps} taps cannot resolve a {low:g} Hz corner at {sampling_rate:g} Hz "
+                             f"(at least {min_taps} needed); decimate the data first")
+        super().__init__(bandpass_taps(low / sampling_rate, high / sampling_rate, n_taps))
+
+
+class Decimator(FIRFilter):
+    """Anti-aliasing lowpass followed by keeping every factor-th sample."""
+
+    def __init__(self, factor, n_taps=None):
+        if n_taps is None:
+            n_taps = 20 * factor + 1
+        super().__init__(lowpass_taps(0.4 / factor, n_taps))
+        self.factor = factor
+        self.phase = 0
+
+    def reset(self):
+        super().reset()
+        self.phase = 0
+
+    def __call__(self, x):
+        y = super().__call__(x)[self.phase::self.factor]
+        self.phase = (self.phase - len(x)) % self.factor
+        return y
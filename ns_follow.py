@@ -0,0 +1,146 @@
+import os
+import struct
+import time
+import numpy as np
+from ns_cache import cache_file_path, extend_nev_cache, nev_packet_dtype
+from ns_openfile import FileInfo, read_nsx_headers
+
+# Followers for NEV and NSx files that are still being recorded. Each one polls the
+# file size and yields only the data appended since the previous poll, in chunks of
+# bounded size, so memory use does not grow with the length of the recording.
+
+
+def wait_for_data(poll_interval, timeout, idle_since):
+    """Sleep for one poll interval; False once the file has been idle for timeout seconds."""
+    if timeout is not None and time.monotonic() - idle_since >= timeout:
+        return False
+    time.sleep(poll_interval)
+    return True
+
+
+def follow_nev(filepath, poll_interval=0.1, from_start=False, max_packets=65536, timeout=None,
+               update_cache=True, cache_dir=None):
+    """Yield the event packets appended to a NEV file as they are written.
+
+    Each item maps Index (packet number), TimeStamp, PacketID and Class to arrays of at
+    most max_packets packets. Only complete packets are read. With from_start=False
+    the packets already in the file are skipped. With update_cache=True the cache used
+    by ns_openfile is extended with the new packets instead of being rebuilt; reopening
+    the file then only reads the packets appended since the last poll. The generator
+    stops once no data has arrived for timeout seconds (never when timeout is None).
+    """
+    with open(filepath, 'rb') as fid:
+        fid.seek(12, os.SEEK_SET)
+        bytes_headers, bytes_data_packet = struct.unpack('<II', fid.read(8))
+    dtype = nev_packet_dtype(bytes_data_packet)
+    cache_file_name = cache_file_path(filepath, cache_dir) if update_cache else None
+
+    def n_available():
+        return max(os.path.getsize(filepath) - bytes_headers, 0) // bytes_data_packet
+
+    n_seen = 0 if from_start else n_available()
+    if update_cache:
+        extend_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_seen)
+
+    idle_since = time.monotonic()
+    while True:
+        n_data_packets = n_available()
+        if n_data_packets <= n_seen:
+            if not wait_for_data(poll_interval, timeout, idle_since):
+                return
+            continue
+
+        for start in range(n_seen, n_data_packets, max_packets):
+            stop = min(start + max_packets, n_data_packets)
+            packets = np.fromfile(filepath, dtype=dtype, count=stop - start,
+                                  offset=bytes_headers + start * bytes_data_packet)
+            yield {
+                'Index': np.arange(start, stop),
+                'TimeStamp': packets['TimeStamp'].copy(),
+                'PacketID': packets['PacketID'].copy(),
+                'Class': packets['Class'].copy(),
+            }
+
+        n_seen = n_data_packets
+        if update_cache:
+            extend_nev_cache(filepath, cache_file_name, bytes_headers, bytes_data_packet, n_seen)
+        idle_since = time.monotonic()
+
+
+def follow_nsx(filepath, poll_interval=0.1, from_start=False, max_points=30000, timeout=None,
+               scale=False):
+    """Yield the samples appended to an NSx file as they are written.
+
+    Each item maps Block (data block number), TimeStamp (timestamp of the first sample)
+    and Data, a (n_points, chan_count) array of at most max_points samples, converted
+    to entity units when scale=True. A block whose Number of Data Points is still 0 is
+    treated as growing. With from_start=False the samples already in the file are
+    skipped. The generator stops once no data has arrived for timeout seconds.
+    """
+    file_info = FileInfo()
+    with open(filepath, 'rb') as fid:
+        file_info.file_type_id = fid.read(8).decode('utf-8')
+        read_nsx_headers(fid, file_info)
+    bytes_per_sample = file_info.sample_dtype.itemsize * file_info.chan_count
+    scales = np.array([entity.scale for entity in file_info.entity], dtype=np.float32)
+
+    # Current block: offset of its header, timestamp, declared points and points read
+    header_offset = file_info.bytes_headers
+    block = None
+    i_block = -1
+    skipping = not from_start
+
+    idle_since = time.monotonic()
+    with open(filepath, 'rb') as fid:
+        while True:
+            file_size = os.path.getsize(filepath)
+            new_data = False
+
+            while True:
+                if block is None:
+                    if header_offset + 9 > file_size:
+                        break
+                    fid.seek(header_offset, os.SEEK_SET)
+                    _, time_stamp, n_points = struct.unpack('<BII', fid.read(9))
+                    block = [time_stamp, n_points, 0]
+                    i_block += 1
+                elif block[1] == 0:
+                    # The number of points may be filled in once the block is closed
+                    fid.seek(header_offset + 5, os.SEEK_SET)
+                    block[1] = struct.unpack('<I', fid.read(4))[0]
+
+                time_stamp, n_points, n_read = block
+                data_offset = header_offset + 9
+                n_written = (file_size - data_offset) // bytes_per_sample
+                if n_points:
+                    n_written = min(n_written, n_points)
+
+                if skipping:
+                    block[2] = n_read = n_written
+
+                if n_written > n_read:
+                    n_new = min(n_written - n_read, max_points)
+                    fid.seek(data_offset + n_read * bytes_per_sample, os.SEEK_SET)
+                    data = np.fromfile(fid, dtype=file_info.sample_dtype, count=n_new * file_info.chan_count)
+                    data = data.reshape(n_new, file_info.chan_count)
+                    block[2] += n_new
+                    new_data = True
+                    yield {
+                        'Block': i_block,
+                        'TimeStamp': time_stamp + n_read * file_info.period,
+                        'Data': data * scales if scale else data,
+                    }
+                    continue
+
+                if n_points and n_read == n_points:
+                    # Block complete: move on to the next data packet header
+                    header_offset = data_offset + n_points * bytes_per_sample
+                    block = None
+                    continue
+                break
+
+            skipping = False
+            if new_data:
+                idle_since = time.monotonic()
+            elif not wait_for_data(poll_interval, timeout, idle_since):
+                return
@@ -1,47 +1,191 @@
+import glob
 import os
 import struct
-import mmap
+import threading
 import numpy as np
-import tkinter as tk
-from tkinter.filedialog import askopenfilename
+from ns_analog import scan_nsx_blocks
+from ns_cache import MemoryMap, open_nev_cache, read_key_counts
+from ns_events import EventIndex
+from ns_stats import OpenStats, counting_file, emit_stats, phase, stats_enabled
+
+
+class LoadedAttribute:
+    """Attribute computed by the data pass of a file.
+
+    Reading it first loads the data section of the file it belongs to, so handles
+    opened with lazy=True expose header information immediately and scan the data
+    only when counts, time spans or the memory map are needed. Counts and time spans
+    use load_counts, which skips the data pass when they are already known (e.g.
+    from a batch manifest).
+    """
+
+    def __init__(self, load='load'):
+        self.load = load
+
+    def __set_name__(self, owner, name):
+        self.name = '_' + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        getattr(obj, self.load)()
+        return getattr(obj, self.name)
+
+    def __set__(self, obj, value):
+        setattr(obj, self.name, value)
 
 
 class HFile:
+    __slots__ = ('name', 'file_path', 'file_info', 'file_infos', '_time_span', 'entity', 'time_stamps',
+                 'lock')
+    time_span = LoadedAttribute('load_counts')
+
     def __init__(self):
         self.name = None
         self.file_path = None
         self.file_info = None
+        self.file_infos = []
         self.time_span = 0
         self.entity = []
         self.time_stamps = []
+        self.lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return all(file_info.is_loaded for file_info in self.file_infos)
+
+    def load(self, max_workers=None):
+        """Run the data pass of every file, in parallel when there is more than one."""
+        pending = [file_info for file_info in self.file_infos if not file_info.is_loaded]
+        if len(pending) > 1 and max_workers != 1:
+            # Imported here: concurrent.futures is only needed to open several files
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(FileInfo.load, pending))
+        else:
+            for file_info in pending:
+                file_info.load()
+
+    def load_counts(self):
+        for file_info in self.file_infos:
+            file_info.load_counts()
+
+    def update(self):
+        """Merge the entities and time spans of all files into the handle."""
+        with self.lock:
+            # Neural entities go after all other entities, as in the Neuroshare dll
+            self.entity = ([entity for file_info in self.file_infos for entity in file_info.entity] +
+                           [entity for file_info in self.file_infos for entity in file_info.neural_entity])
+            self._time_span = max([0] + [file_info._time_span for file_info in self.file_infos])
+
+    def get_entity(self, entity):
+        """entity itself if it is an Entity, else the entity at that index of hfile.entity.
+
+        Indices refer to hfile.entity after the data pass, which replaces the entities
+        read from the headers, so the counts of lazy handles are loaded first.
+        """
+        if isinstance(entity, (int, np.integer)):
+            self.load_counts()
+            return self.entity[entity]
+        return entity
+
+    def get_file_info(self, file_type_id='NEURALEV'):
+        """First opened file with the given File Type ID, or None."""
+        for file_info in self.file_infos:
+            if file_info.file_type_id == file_type_id:
+                return file_info
+        return None
 
     def __repr__(self):
         entity_str = f"[1×{len(self.entity)} entity object]"
         file_info_str = "FileInfo object" if self.file_info is not None else "None"
+        file_infos_str = f"[1×{len(self.file_infos)} FileInfo object]"
+        counted = all(file_info.is_loaded or file_info.counted for file_info in self.file_infos)
+        time_span_str = self.time_span if counted else "(not loaded)"
         return (
             f"\nhFile:\n"
             f"\tname: {self.name}\n"
             f"\tfile_path: {self.file_path}\n"
             f"\tfile_info: {file_info_str}\n"
+            f"\tfile_infos: {file_infos_str}\n"
             f"\tentity: {entity_str}\n"
-            f"\ttime_span: {self.time_span}\n"
+            f"\ttime_span: {time_span_str}\n"
         )
 
 
 class FileInfo:
+    # Slots for LoadedAttribute values are the attribute names prefixed with '_'
+    __slots__ = ('loader', 'loading', 'lock', 'entity', 'neural_entity', 'type', 'file_name', 'file_size',
+                 'file_type_id', 'label', 'bytes_headers', 'bytes_data_packet', '_memory_map',
+                 'cache_file_name', '_event_index', 'epoch_starts', 'waveforms', '_blocks', 'block_views',
+                 'electrode_list', '_time_span', 'period', 'n_extended_headers', 'digital_labels',
+                 'chan_count', 'sample_dtype', 'stats', 'counted')
+    memory_map = LoadedAttribute()
+    event_index = LoadedAttribute()
+    blocks = LoadedAttribute()
+    time_span = LoadedAttribute('load_counts')
+
     def __init__(self):
+        self.loader = None
+        self.loading = False
+        self.counted = False
+        self.lock = threading.RLock()
+        self.entity = []
+        self.neural_entity = []
         self.type = None
+        self.file_name = None
         self.file_size = None
         self.file_type_id = None
         self.label = None
         self.bytes_headers = None
         self.bytes_data_packet = None
         self.memory_map = None
+        self.cache_file_name = None
+        self.event_index = None
+        self.epoch_starts = None
+        self.waveforms = None
+        self.blocks = None
         self.electrode_list = []
         self.time_span = 0  # Duplicate time_span in FileInfo?
+        self.period = None
+        self.n_extended_headers = None
+        self.digital_labels = None
+        self.chan_count = None
+        self.sample_dtype = None
+        self.block_views = None
+        self.stats = None
+
+    @property
+    def is_loaded(self):
+        return self.loader is None
+
+    def load(self):
+        """Run the data pass of the file if it has been deferred."""
+        if self.loader is None:
+            return
+        with self.lock:
+            # Other threads wait for the load to finish; reads made by the loader
+            # itself return straight away
+            if self.loader is None or self.loading:
+                return
+            self.loading = True
+            try:
+                self.loader()
+            finally:
+                self.loading = False
+            self.loader = None
+
+    def load_counts(self):
+        """Run the data pass unless the entity counts and time span are already known."""
+        if not self.counted:
+            self.load()
 
     def __repr__(self):
-        memory_map_str = f"[1×{len(self.memory_map)} mmap object]" if self.memory_map is not None else "None"
+        if not self.is_loaded:
+            memory_map_str = "(not loaded)"
+        else:
+            memory_map_str = f"[1×{len(self.memory_map)} mmap object]" if self.memory_map is not None else "None"
+        time_span_str = self.time_span if self.is_loaded or self.counted else "(not loaded)"
         return (
             f"\nFileInfo:\n"
             f"\ttype: {self.type}\n"
@@ -51,13 +195,18 @@ class FileInfo:
             f"\tbytes_headers: {self.bytes_headers}\n"
             f"\tbytes_data_packet: {self.bytes_data_packet}\n"
             f"\tmemory_map: {memory_map_str}\n"
-            f"\ttime_span: {self.time_span}\n"
+            f"\ttime_span: {time_span_str}\n"
             f"\telectrode_list: {self.electrode_list}\n"
         )
 
 
 class Entity:
-    def __init__(self):
+    __slots__ = ('file_info', 'electrode_id', 'entity_type', 'reason', '_count', 'scale', 'units', 'n_units',
+                 'label', 'channel_index', 'bytes_per_waveform', 'file_type')
+    count = LoadedAttribute('load_counts')
+
+    def __init__(self, file_info=None):
+        self.file_info = file_info
         self.electrode_id = None
         self.entity_type = None
         self.reason = None
@@ -66,16 +215,26 @@ class Entity:
         self.units = None
         self.n_units = 0
         self.label = None
+        self.channel_index = None
+        self.bytes_per_waveform = None
+        self.file_type = None
+
+    def load_counts(self):
+        if self.file_info is not None:
+            self.file_info.load_counts()
 
     def __repr__(self):
         scale_str = f"{self.scale:.4e}" if self.scale is not None else "None"
+        file_info = self.file_info
+        counted = file_info is None or file_info.is_loaded or file_info.counted
+        count_str = self.count if counted else "(not loaded)"
         return (
             f"\nEntity:\n"
             f"\telectrode_id: {self.electrode_id}\n"
             f"\tlabel: {self.label}\n"
             f"\tentity_type: {self.entity_type}\n"
             f"\treason: {self.reason}\n"
-            f"\tcount: {self.count}\n"
+            f"\tcount: {count_str}\n"
             f"\tscale: {scale_str}\n"
             f"\tunits: {self.units}\n"
             f"\tnumber_of_units: {self.n_units}\n"
@@ -87,347 +246,413 @@ def is_valid_file(file):
     return file.lower().endswith(valid_extensions)
 
 
-def file_dialog():
-    root = tk.Tk()
-    root.withdraw()  # Hide the main window
+def read_nev_headers(fid, file_info):
+    # Skip: File Spec and Additional Flags header Information
+    fid.seek(4, os.SEEK_CUR)
+    file_info.label = 'neural events'
+    file_info.period = 1
+
+    # Read BytesHeaders and BytesDataPacket
+    file_info.bytes_headers = struct.unpack('I', fid.read(4))[0]
+    file_info.bytes_data_packet = struct.unpack('I', fid.read(4))[0]
+
+    # Skip: Time Resolution of Time Stamps, Time Resolution of Samples,
+    # Time Origin, Application to Create File, and Comment field
+    fid.seek(312, os.SEEK_CUR)
+
+    # Read the number of extended headers
+    file_info.n_extended_headers = struct.unpack('I', fid.read(4))[0]
+
+    # Read PacketIDs
+    packet_ids = []
+    for _ in range(file_info.n_extended_headers):
+        packet_id = fid.read(8).decode('utf-8').strip()
+        fid.seek(24, os.SEEK_CUR)  # Skip the 24 bytes of information
+        packet_ids.append(packet_id)
+
+    # Get index of NEUEVWAV extended headers
+    idx_evwav = [i for i, pid in enumerate(
+        packet_ids) if pid == 'NEUEVWAV']
+
+    for j in idx_evwav:
+        fid.seek(344 + (j * 32), os.SEEK_SET)
+        entity = Entity(file_info)
+        entity.entity_type = 'Segment'
+        entity.reason = 0
+        entity.units = 'uV'
+        entity.count = 0
+        entity.electrode_id = struct.unpack('H', fid.read(2))[0]
+
+        # Skip: Physical Connector
+        fid.seek(2, os.SEEK_CUR)
+
+        # Scale factor should convert bits to microvolts (nanovolts natively)
+        entity.scale = struct.unpack('H', fid.read(2))[0] * 10**-3
+
+        # Skip: Energy Threshold, High Threshold, Low Threshold
+        fid.seek(6, os.SEEK_CUR)
+
+        entity.n_units = struct.unpack('B', fid.read(1))[0]
+        entity.bytes_per_waveform = struct.unpack('B', fid.read(1))[0]
+
+        # If scale factor = 0, use stim amp digitization factor
+        if entity.scale == 0:
+            # Scale factor should convert bits to volts (volts natively)
+            entity.scale = struct.unpack('f', fid.read(4))[0]
+            entity.units = 'V'
+
+        file_info.entity.append(entity)
+
+    # Process NEUEVLBL extended headers
+    idx_evlbl = [i for i, pid in enumerate(
+        packet_ids) if pid == 'NEUEVLBL']
+    for j in idx_evlbl:
+        fid.seek(344 + (j * 32), os.SEEK_SET)
+        elec_id = struct.unpack('H', fid.read(2))[0]
+
+        # Find the entity with the matching electrode ID
+        for entity in file_info.entity:
+            if entity.electrode_id == elec_id:
+                lbl = fid.read(16).decode(
+                    'utf-8').rstrip('\x00').strip()
+                entity.label = lbl
+
+    # Get index of DIGLABEL extended headers
+    idx_diglbl = [i for i, pid in enumerate(
+        packet_ids) if pid == 'DIGLABEL']
+    dig_lbls = [None] * 6
+    if len(idx_diglbl) == 5:
+        dig_lbls = [None] * 6
+        for j, idx in enumerate(idx_diglbl):
+            fid.seek(344 + (idx * 32), os.SEEK_SET)
+            idx = (j % 5) + 1
+            dig_lbls[idx] = fid.read(16).decode('utf-8').rstrip('\x00').strip()
+            mode = struct.unpack('B', fid.read(1))[0]
+            elec_id = struct.unpack('H', fid.read(2))[0]
+        dig_lbls[5] = 'Output Echo'
+    file_info.digital_labels = dig_lbls
+
+    file_info.electrode_list = [ent.electrode_id for ent in file_info.entity]
+
+
+def map_nev_data(file_info, cache_dir=None, cache_max_bytes=None):
+    """Map the NEV cache and set up the event index; returns the number of data packets."""
+    stats = file_info.stats
+    n_data_packets = (
+        file_info.file_size - file_info.bytes_headers) // file_info.bytes_data_packet
+
+    if n_data_packets == 0:
+        file_info.memory_map = None
+        return 0
+
+    # Create (or reuse) a cache file to hold NEV event information, and memory map it;
+    # the columns are paged in on access. Two first opens of a growing file can race to
+    # build its cache, and the one that saw fewer packets may rename its cache over the
+    # other's; the cache is then extended again
+    for attempt in range(3):
+        with phase(stats, 'cache'):
+            cache_file_name = open_nev_cache(file_info.file_name, file_info.bytes_headers,
+                                             file_info.bytes_data_packet, n_data_packets,
+                                             cache_dir, cache_max_bytes, stats)
+        try:
+            with phase(stats, 'memory_map'):
+                data = MemoryMap(cache_file_name, n_data_packets)
+            break
+        except OSError:
+            if attempt == 2:
+                raise
+    file_info.cache_file_name = cache_file_name
+    file_info.memory_map = data
+
+    # Index the packets by electrode and class from the key counts stored in the cache;
+    # the per-packet order is only sorted on the first lookup
+    with phase(stats, 'event_index'):
+        keys, counts = read_key_counts(cache_file_name) or (None, None)
+        if counts is not None and counts.sum() != n_data_packets:
+            # Another reader of the growing file has extended the cache since; count the keys
+            # of the mapped packets instead
+            keys, counts = None, None
+        event_index = EventIndex(data['TimeStamp'], data['PacketID'], data['Class'], keys, counts)
+    file_info.event_index = event_index
+    return n_data_packets
+
+
+def read_nev_data(file_info, cache_dir=None, cache_max_bytes=None):
+    stats = file_info.stats
+    if map_nev_data(file_info, cache_dir, cache_max_bytes) == 0:
+        file_info.electrode_list = [ent.electrode_id for ent in file_info.entity]
+        remove_empty_entities(file_info)
+        return
+    data = file_info.memory_map
+    event_index = file_info.event_index
+
+    with phase(stats, 'entity_counts'):
+        # Get number of occurrences of each ElectrodeID in the NEV file, in one lookup
+        electrode_ids = np.array([ent.electrode_id for ent in file_info.entity], dtype=np.int64)
+        counts = event_index.count_many(electrode_ids)
+
+        # Remove Entities that do not have neural events from the entity list
+        keep = (electrode_ids != 0) & (counts > 0)
+        file_info.entity = [ent for ent, kept in zip(file_info.entity, keep) if kept]
+        for ent, count in zip(file_info.entity, counts[keep].tolist()):
+            ent.count = count
+
+    # Calculate the Timespan in 30kHz
+    file_info.time_span = data['TimeStamp'][-1]
+
+    with phase(stats, 'digital_events'):
+        if event_index.count(0):
+            # Get the classes of all digital events and how often each occurs
+            first, last = event_index.runs(0)
+            event_class = event_index.classes[first:last]
+            event_class_count = event_index.counts[first:last]
+            packet_reason = ['Parallel Input', 'SMA 1',
+                             'SMA 2', 'SMA 3', 'SMA 4', 'Output Echo']
+
+            # Create Entities for digital channels that have events in the file
+            for j in range(6):
+                count = int(event_class_count[np.bitwise_and(event_class, 1 << j) != 0].sum())
+                if count:
+                    entity = Entity(file_info)
+                    entity.entity_type = 'Event'
+                    entity.reason = packet_reason[j]
+                    entity.label = file_info.digital_labels[j]
+                    entity.count = count
+                    entity.electrode_id = 0
+                    file_info.entity.append(entity)
+
+    with phase(stats, 'neural_entities'):
+        # Setup neural entities and update file_info with neural data
+        file_info.electrode_list = [
+            ent.electrode_id for ent in file_info.entity]
+
+        # Get a list of all unique neural entities that have been found
+        class_list = np.unique(event_index.classes)
+
+        # Count every (electrode, class) pair at once; pairs are ordered class-major as
+        # in the MATLAB reference, and only those with events become entities
+        electrodes = np.array([elec for elec in file_info.electrode_list if elec != 0], dtype=np.int64)
+        pair_counts = event_index.count_many(electrodes[None, :], class_list[:, None].astype(np.int64))
+        i_class, i_electrode = np.nonzero(pair_counts)
+
+        neural_entities = []
+        for elec_id, class_val, count in zip(electrodes[i_electrode].tolist(), class_list[i_class],
+                                             pair_counts[i_class, i_electrode].tolist()):
+            entity = Entity(file_info)
+            entity.entity_type = 'Neural'
+            entity.electrode_id = elec_id
+            entity.reason = class_val
+            entity.count = count
+            neural_entities.append(entity)
+
+        # Keep the neural entities apart; they are appended after all other entities
+        file_info.neural_entity = neural_entities
+
+
+def read_nsx_headers(fid, file_info):
+    float_stream = file_info.file_type_id == 'NEUCDFLT'
+
+    fid.seek(2, os.SEEK_CUR)
+    file_info.bytes_headers = struct.unpack('I', fid.read(4))[0]
+    file_info.label = fid.read(16).decode('utf-8').rstrip('\x00').strip()
+    fid.seek(256, os.SEEK_CUR)
+    file_info.period = struct.unpack('I', fid.read(4))[0]
+    fid.seek(20, os.SEEK_CUR)
+    chan_count = struct.unpack('I', fid.read(4))[0]
+    for j in range(chan_count):
+        entity = Entity(file_info)
+        entity.file_type = file_info.file_type_id
+        entity.entity_type = 'Analog'
+        entity.channel_index = j
+        fid.seek(2, os.SEEK_CUR)
+
+        entity.electrode_id = struct.unpack('H', fid.read(2))[0]
+        entity.label = fid.read(16).decode('utf-8').rstrip('\x00').strip()
+
+        fid.seek(2, os.SEEK_CUR)
+        analog_scale = struct.unpack('4h', fid.read(8))
+
+        if float_stream:
+            entity.scale = 1.0
+        else:
+            entity.scale = (
+                analog_scale[3] - analog_scale[2]) / (analog_scale[1] - analog_scale[0])
 
-    selected_file = askopenfilename(
-        initialdir=os.getcwd(),
-        title="Select a NEV or NS* file",
-        filetypes=(("NEV and NS* files",
-                   "*.nev *.ns1 *.ns2 *.ns3 *.ns4 *.ns5 *.ns6"), ("All files", "*.*"))
-    )
+        entity.units = fid.read(16).decode('utf-8').rstrip('\x00').strip()
 
-    if selected_file and is_valid_file(selected_file):
-        print("\nSelected file:")
-        print(f"- {selected_file}")
-        valid_file = selected_file
-    else:
-        print("No valid file selected")
-        valid_file = None
+        fid.seek(20, os.SEEK_CUR)
+        file_info.entity.append(entity)
 
-    root.destroy()
-    return valid_file
+    file_info.electrode_list = [e.electrode_id for e in file_info.entity]
+    file_info.chan_count = chan_count
+    file_info.sample_dtype = np.dtype('<f4' if float_stream else '<i2')
 
 
-def ns_openfile(filepath=None):
-    hfile = HFile()
-    if filepath is None:
-        filepath = file_dialog()
-    hfile.file_path, hfile.name = os.path.split(filepath)
-    file_info = FileInfo()
-    ns_result = 'ns_OK'
-    with open(filepath, 'rb') as fid:
-        file_info.type = filepath.split('.')[-1]
-        file_info.file_type_id = fid.read(8).decode('utf-8')
-        file_info.file_size = os.path.getsize(filepath)
-
-        if file_info.file_type_id == 'NEURALEV':
+def index_nsx_blocks(file_info):
+    # Index the data blocks: file offset, start timestamp and number of points
+    with open(file_info.file_name, 'rb') as fid, phase(file_info.stats, 'blocks'):
+        file_info.blocks = scan_nsx_blocks(counting_file(fid, file_info.stats), file_info.bytes_headers,
+                                           file_info.file_size, file_info.chan_count,
+                                           file_info.sample_dtype.itemsize)
+    file_info.block_views = [None] * len(file_info.blocks)
 
-            # Skip: File Spec and Additional Flags header Information
-            fid.seek(4, os.SEEK_CUR)
-            file_info.label = 'neural events'
-            file_info.period = 1
-
-            # Read BytesHeaders and BytesDataPacket
-            file_info.bytes_headers = struct.unpack('I', fid.read(4))[0]
-            file_info.bytes_data_packet = struct.unpack('I', fid.read(4))[0]
-
-            # Skip: Time Resolution of Time Stamps, Time Resolution of Samples,
-            # Time Origin, Application to Create File, and Comment field
-            fid.seek(312, os.SEEK_CUR)
-
-            # Read the number of extended headers
-            file_info.n_extended_headers = struct.unpack('I', fid.read(4))[0]
-
-            # Read PacketIDs
-            packet_ids = []
-            for _ in range(file_info.n_extended_headers):
-                packet_id = fid.read(8).decode('utf-8').strip()
-                fid.seek(24, os.SEEK_CUR)  # Skip the 24 bytes of information
-                packet_ids.append(packet_id)
-
-            # Get index of NEUEVWAV extended headers
-            idx_evwav = [i for i, pid in enumerate(
-                packet_ids) if pid == 'NEUEVWAV']
-
-            for j in idx_evwav:
-                fid.seek(344 + (j * 32), os.SEEK_SET)
-                entity = Entity()
-                entity.entity_type = 'Segment'
-                entity.reason = 0
-                entity.units = 'uV'
-                entity.count = 0
-                entity.electrode_id = struct.unpack('H', fid.read(2))[0]
-
-                # Skip: Physical Connector
-                fid.seek(2, os.SEEK_CUR)
-
-                # Scale factor should convert bits to microvolts (nanovolts natively)
-                entity.scale = struct.unpack('H', fid.read(2))[0] * 10**-3
-
-                # Skip: Energy Threshold, High Threshold, Low Threshold
-                fid.seek(6, os.SEEK_CUR)
-
-                entity.n_units = struct.unpack('B', fid.read(1))[0]
-
-                # If scale factor = 0, use stim amp digitization factor
-                if entity.scale == 0:
-                    # Skip: Bytes per Waveform
-                    fid.seek(1, os.SEEK_CUR)
-                    # Scale factor should convert bits to volts (volts natively)
-                    entity.scale = struct.unpack('f', fid.read(4))[0]
-                    entity.units = 'V'
-
-                hfile.entity.append(entity)
-
-            file_info.file_size = os.path.getsize(filepath)
-            n_data_packets = (
-                file_info.file_size - file_info.bytes_headers) // file_info.bytes_data_packet
-
-            # Process NEUEVLBL extended headers
-            idx_evlbl = [i for i, pid in enumerate(
-                packet_ids) if pid == 'NEUEVLBL']
-            for j in idx_evlbl:
-                fid.seek(344 + (j * 32), os.SEEK_SET)
-                elec_id = struct.unpack('H', fid.read(2))[0]
-
-                # Find the entity with the matching electrode ID
-                for entity in hfile.entity:
-                    if entity.electrode_id == elec_id:
-                        lbl = fid.read(16).decode(
-                            'utf-8').rstrip('\x00').strip()
-                        entity.label = lbl
-
-            if n_data_packets == 0:
-                file_info.memory_map = None
-                file_info.electrode_list = [
-                    ent.electrode_id for ent in hfile.entity if hasattr(ent, 'electrode_id')]
-                return file_info
 
-            # Create a cache file to hold NEV event information
-            cache_file_name = os.path.join(
-                hfile.file_path, f"{os.path.splitext(os.path.basename(hfile.name))[0]}.cache"
-            )
-
-            if not os.path.exists(cache_file_name):
-                with open(cache_file_name, 'wb') as cache_id:
-                    fid.seek(file_info.bytes_headers, os.SEEK_SET)
-
-                    # Write timestamps to cache file
-                    timestamps = []
-                    for _ in range(n_data_packets):
-                        timestamp = struct.unpack('<I', fid.read(4))[
-                            0]  # Ensure little-endian
-                        timestamps.append(timestamp)
-                        cache_id.write(struct.pack('<I', timestamp))
-                        fid.seek(file_info.bytes_data_packet - 4, os.SEEK_CUR)
-
-                    # Check the position of the file pointer
-                    fid.seek(file_info.bytes_headers + 4, os.SEEK_SET)
-
-                    # Write Packet ID to cache file
-                    packet_ids = []
-                    for _ in range(n_data_packets):
-                        packet_id = struct.unpack('<H', fid.read(2))[
-                            0]  # Ensure little-endian
-                        packet_ids.append(packet_id)
-                        cache_id.write(struct.pack('<H', packet_id))
-                        fid.seek(file_info.bytes_data_packet - 2, os.SEEK_CUR)
-
-                    # Seek to the position for reading Classification/Insertion Reason
-                    fid.seek(file_info.bytes_headers + 6, os.SEEK_SET)
-
-                    # Write Classification/Insertion Reasons to cache file
-                    reasons = []
-                    for _ in range(n_data_packets):
-                        reason = struct.unpack('B', fid.read(1))[0]
-                        reasons.append(reason)
-                        cache_id.write(struct.pack('B', reason))
-                        fid.seek(file_info.bytes_data_packet - 1, os.SEEK_CUR)
-
-            # Memory map the cache file
-            with open(cache_file_name, 'r+b') as cache_id:
-                mm = mmap.mmap(cache_id.fileno(), 0)
-
-                # Correctly slice the memory map
-                timestamps_from_map = np.frombuffer(
-                    mm[:n_data_packets * 4], dtype='uint32')
-                packet_ids_from_map = np.frombuffer(
-                    mm[n_data_packets * 4:n_data_packets * (4 + 2)], dtype='uint16')
-                reasons_from_map = np.frombuffer(
-                    mm[n_data_packets * (4 + 2):n_data_packets * (4 + 2 + 1)], dtype='uint8')
-
-                # Assign the data to a structured array for easy access
-                data = np.zeros(n_data_packets, dtype=[
-                                ('TimeStamp', 'uint32'), ('PacketID', 'uint16'), ('Class', 'uint8')])
-                data['TimeStamp'] = timestamps_from_map
-                data['PacketID'] = packet_ids_from_map
-                data['Class'] = reasons_from_map
-
-            file_info.memory_map = data
-
-            # Get a list of unique Packet IDs
-            unique_packet_ids = np.unique(data['PacketID'])
-
-            # Filter entities based on Packet IDs
-            if hasattr(hfile.entity[0], 'electrode_id'):
-                all_channels = np.array(
-                    [ent.electrode_id for ent in hfile.entity])
-
-                # Remove Entities that do not have neural events from the entity list
-                mask = np.isin(
-                    all_channels, unique_packet_ids[unique_packet_ids != 0])
-                hfile.entity = [ent for ent, keep in zip(
-                    hfile.entity, mask) if keep]
-
-            # Get number of occurrences of each ElectrodeID in the NEV file
-            if hfile.entity:
-                for ent in hfile.entity:
-                    ent.count = np.sum(data['PacketID'] == ent.electrode_id)
-
-            # Calculate the Timespan in 30kHz
-            file_info.time_span = data['TimeStamp'][-1]
-            # Update if necessary
-            if hfile.time_span < file_info.time_span:
-                hfile.time_span = file_info.time_span
-
-            if file_info.memory_map['PacketID'][0] == 0:
-                # Get all digital events
-                event_class = file_info.memory_map['Class'][file_info.memory_map['PacketID'] == 0]
-                packet_reason = ['Parallel Input', 'SMA 1',
-                                 'SMA 2', 'SMA 3', 'SMA 4', 'Output Echo']
-                EC = len(hfile.entity)
-                k = EC + 1
-
-                # Get index of DIGLABEL extended headers
-                idx_diglbl = [i for i, pid in enumerate(
-                    packet_ids) if pid == 'DIGLABEL']
-                dig_lbls = [None] * 6
-                if len(idx_diglbl) == 5:
-                    dig_lbls = [None] * 6
-                    for j, idx in enumerate(idx_diglbl):
-                        fid.seek(344 + (idx * 32), os.SEEK_SET)
-                        idx = (j % 5) + 1
-                        dig_lbls[idx] = fid.read(16).decode('utf-8').strip()
-                        mode = struct.unpack('B', fid.read(1))[0]
-                        elec_id = struct.unpack('H', fid.read(2))[0]
-                    dig_lbls[5] = 'Output Echo'
-
-                # Create Entities for digital channels that have events in the file
-                for j in range(6):
-                    count = np.sum(np.bitwise_and(event_class, 1 << j))
-                    if count:
-                        entity = Entity()
-                        entity.entity_type = 'Event'
-                        entity.reason = packet_reason[j]
-                        entity.label = dig_lbls[j]
-                        entity.count = count
-                        entity.electrode_id = 0
-                        hfile.entity.append(entity)
-
-            # Setup neural entities and update file_info with neural data
-            file_info.electrode_list = [
-                ent.electrode_id for ent in hfile.entity]
-
-            # Get a list of all unique neural entities that have been found
-            class_list = np.sort(np.unique(data['Class']))
-
-            # Find out how many unique electrodes and classes we have
-            n_electrode = len(
-                [elec for elec in file_info.electrode_list if elec != 0])
-            n_class = len(class_list)
-
-            # Create space for the Neural entities
-            neural_entities = [Entity() for _ in range(n_electrode * n_class)]
-
-            # Create an entity for each possible electrode and class
-            for i_entity in range(n_electrode):
-                elec_id = file_info.electrode_list[i_entity]
-                if elec_id != 0:
-                    indices = data['PacketID'] == elec_id
-                    classes = data['Class'][indices]
-                    for i_class in range(n_class):
-                        class_val = class_list[i_class]
-                        neural_index = i_entity + i_class * n_electrode
-                        neural_entities[neural_index].electrode_id = elec_id
-                        neural_entities[neural_index].reason = class_val
-                        neural_entities[neural_index].count = np.sum(
-                            classes == class_val)
-
-            # Append the neural entities to hfile.entity
-            neural_entities = [
-                entity for entity in neural_entities if entity.count > 0]
-            hfile.entity.extend(neural_entities)
-        elif file_info.file_type_id in ['NEURALCD', 'NEUCDFLT']:
-            float_stream = file_info.file_type_id == 'NEUCDFLT'
+def read_nsx_data(file_info):
+    index_nsx_blocks(file_info)
+    n_points = int(file_info.blocks['NumPoints'].sum())
 
-            fid.seek(2, os.SEEK_CUR)
-            file_info.bytes_headers = struct.unpack('I', fid.read(4))[0]
-            file_info.label = fid.read(16).decode('utf-8').strip()
-            fid.seek(256, os.SEEK_CUR)
-            file_info.period = struct.unpack('I', fid.read(4))[0]
-            fid.seek(20, os.SEEK_CUR)
-            chan_count = struct.unpack('I', fid.read(4))[0]
-            EC = len(hfile.entity)
-            for j in range(EC, EC + chan_count):
-                entity = Entity()
-                entity.file_type = file_info.file_type_id
-                entity.entity_type = 'Analog'
-                fid.seek(2, os.SEEK_CUR)
+    for e in file_info.entity:
+        e.count = n_points
 
-                entity.electrode_id = struct.unpack('H', fid.read(2))[0]
-                entity.label = fid.read(16).decode('utf-8').strip()
+    # Calculate the Timespan in 30kHz: end of the last data block
+    if len(file_info.blocks):
+        last = file_info.blocks[-1]
+        file_info.time_span = int(last['TimeStamp']) + int(last['NumPoints']) * file_info.period
 
-                fid.seek(2, os.SEEK_CUR)
-                analog_scale = struct.unpack('4h', fid.read(8))
+    remove_empty_entities(file_info)
 
-                if float_stream:
-                    entity.scale = 1.0
-                else:
-                    entity.scale = (
-                        analog_scale[3] - analog_scale[2]) / (analog_scale[1] - analog_scale[0])
 
-                entity.units = fid.read(16).decode('utf-8').strip()
+def remove_empty_entities(file_info):
+    file_info.entity = [entity for entity in file_info.entity if entity.count > 0]
 
-                fid.seek(20, os.SEEK_CUR)
-                hfile.entity.append(entity)
 
-            file_info.electrode_list = [
-                e.electrode_id for e in hfile.entity[EC:EC + chan_count]]
+def session_files(filepath):
+    """All NEV and NSx files sharing the base name of filepath, e.g. data001.nev and data001.ns5.
 
-            fid.seek(file_info.bytes_headers, os.SEEK_SET)
-            file_size = os.path.getsize(filepath)
-            time_stamps = []
+    An existing filepath is always included, whatever its extension.
+    """
+    path, name = os.path.split(filepath)
+    is_file = os.path.isfile(filepath)
+    base_name = os.path.splitext(name)[0] if is_file or is_valid_file(name) else name
+    pattern = os.path.join(glob.escape(path), glob.escape(base_name) + '.*')
+    files = [file for file in glob.glob(pattern) if is_valid_file(file)]
+    if is_file and os.path.abspath(filepath) not in map(os.path.abspath, files):
+        files.append(filepath)
+    return sorted(files)
 
-            while fid.tell() < file_info.file_size:
-                header = struct.unpack('B', fid.read(1))[0]
-                time_stamp = struct.unpack('I', fid.read(4))[
-                    0] / file_info.period
-                n_points = struct.unpack('I', fid.read(4))[0]
-                time_stamps.append((time_stamp, n_points))
 
-                bytes_per_point = 4 if float_stream else 2
-                fid.seek(bytes_per_point * n_points * chan_count, os.SEEK_CUR)
-
-            for e in hfile.entity[EC:EC + chan_count]:
-                e.count = sum(n_points for ts, n_points in time_stamps)
+def read_file_headers(filepath, hfile, cache_dir=None, cache_max_bytes=None, stats=False,
+                      stats_callback=None):
+    file_info = FileInfo()
+    if stats_enabled(stats, stats_callback):
+        file_info.stats = OpenStats(filepath)
 
-            file_info.time_span = sum(
-                ts * file_info.period for ts, n_points in time_stamps)
+    with open(filepath, 'rb') as raw_fid, phase(file_info.stats, 'headers'):
+        fid = counting_file(raw_fid, file_info.stats)
+        file_info.type = filepath.split('.')[-1]
+        file_info.file_name = filepath
+        file_info.file_type_id = fid.read(8).decode('utf-8', errors='replace')
+        file_info.file_size = os.path.getsize(filepath)
 
-            if hfile.time_span < file_info.time_span:
-                hfile.time_span = file_info.time_span
+        if file_info.file_type_id == 'NEURALEV':
+            read_nev_headers(fid, file_info)
+            read_data = lambda: read_nev_data(file_info, cache_dir, cache_max_bytes)
+        elif file_info.file_type_id in ['NEURALCD', 'NEUCDFLT']:
+            read_nsx_headers(fid, file_info)
+            read_data = lambda: read_nsx_data(file_info)
+        else:
+            return 'ns_FILEERROR', file_info
+
+    def loader():
+        read_data()
+        hfile.update()
+        if file_info.stats is not None:
+            emit_stats(file_info.stats, stats_callback)
+
+    file_info.loader = loader
+    return 'ns_OK', file_info
+
+
+def ns_openfile(filepath=None, cache_dir=None, cache_max_bytes=None, lazy=False, single=False,
+                max_workers=None, stats=False, stats_callback=None):
+    """Open a NEV or NSx file.
+
+    As in the MATLAB reference, every NEV/NSx file sharing the base name of filepath
+    (data001.nev, data001.ns5, ...) is opened into the same handle unless single=True;
+    filepath may also be the base name itself. hfile.file_info is the FileInfo of the
+    requested file and hfile.file_infos lists all opened files. If filepath names a file
+    that cannot be read the open fails with 'ns_FILEERROR'; other files of the session
+    that cannot be read are only left out of hfile.file_infos. The data pass of each
+    file runs on a thread pool of max_workers threads, so a session opens in about the
+    time of its slowest file.
+
+    With lazy=True only the headers are read: entities, labels and scales are available
+    immediately, and the data section is scanned the first time counts, time spans,
+    the memory map or the block index are accessed (or hfile.load() is called). Until
+    then hfile.entity holds the entities declared in the headers; the data pass
+    replaces the list (electrodes without events are dropped, Event and Neural entities
+    added), so code holding the list or indices into it should run hfile.load() first.
+    The reading functions resolve entity indices against the loaded list.
+
+    With stats=True each FileInfo records an OpenStats in file_info.stats: the time
+    spent in each phase of the open, bytes read, seeks and the NEV cache outcome.
+    Once the data pass of a file is done its stats are passed to stats_callback and
+    logged at DEBUG level to the 'ns_openfile' logger; either of these also enables
+    the stats.
+    """
+    hfile = HFile()
+    if filepath is None:
+        # The file dialog needs tkinter, which is only imported when it is used
+        from ns_dialog import file_dialog
+        filepath = file_dialog()
+        if filepath is None:
+            return 'ns_FILEERROR', hfile
+    hfile.file_path, hfile.name = os.path.split(filepath)
 
+    filepaths = [filepath] if single else session_files(filepath)
+    if not filepaths:
+        return 'ns_FILEERROR', hfile
+
+    ns_results = []
+    requested_result = None
+    for file in filepaths:
+        try:
+            ns_result, file_info = read_file_headers(file, hfile, cache_dir, cache_max_bytes, stats,
+                                                     stats_callback)
+        except (OSError, ValueError, struct.error):
+            # Unreadable or malformed headers (e.g. a label that is not valid UTF-8) only
+            # fail their own file, not the rest of the session
+            ns_result, file_info = 'ns_FILEERROR', None
+        ns_results.append(ns_result)
+
+        if ns_result == 'ns_OK':
+            hfile.file_infos.append(file_info)
+        if os.path.abspath(file) == os.path.abspath(filepath):
             hfile.file_info = file_info
+            requested_result = ns_result
 
-        else:
-            ns_result = 'ns_FILEERROR'
-
-    hfile.entity = [entity for entity in hfile.entity if entity.count > 0]
-    hfile.file_info = file_info
+    if requested_result not in (None, 'ns_OK'):
+        # The named file could not be read; the other files of its session do not stand in for it
+        hfile.file_info = None
+        return 'ns_FILEERROR', hfile
+    # filepath is a base name; the handle's file_info is the first file
+    if hfile.file_info is None:
+        hfile.file_info = hfile.file_infos[0] if hfile.file_infos else None
 
-    if ns_result == 'ns_FILEERROR':
-        return ns_result, hfile
+    hfile.update()
+    if not lazy:
+        hfile.load(max_workers)
 
+    ns_result = 'ns_OK' if 'ns_OK' in ns_results else 'ns_FILEERROR'
     return ns_result, hfile
+
+
+def ns_closefile(hfile):
+    """Release the memory maps of every file of the handle.
+
+    The cache, NEV and NSx files stay mapped for as long as any array views them, so
+    every object holding a view is dropped; reads on the closed handle then fail as on
+    a file without data, and files that were never loaded are not loaded any more.
+    """
+    for file_info in hfile.file_infos:
+        with file_info.lock:
+            file_info.loader = None
+            if isinstance(file_info.memory_map, MemoryMap):
+                file_info.memory_map.close()
+            file_info.memory_map = None
+            file_info.event_index = None
+            file_info.epoch_starts = None
+            file_info.waveforms = None
+            file_info.blocks = None
+            file_info.block_views = None
+    return 'ns_OK'
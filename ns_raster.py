@@ -0,0 +1,133 @@
+import numpy as np
+from ns_events import get_event_times
+
+# Spike rasters and peri-event time histograms (PSTHs) from the per-electrode event
+# index. Binning and trigger alignment are done with searchsorted/bincount over whole
+# spike trains, and rasters are drawn as one line artist per group of rows, so the
+# cost does not grow with one Python call per spike. Times are in NEV timestamp units.
+
+
+def get_spike_trains(hfile, electrodes=None, reason=None):
+    """Event times of several electrodes (all Segment entities when electrodes is None).
+
+    Returns (ns_result, electrodes, trains) with one int64 array per electrode.
+    """
+    if electrodes is None:
+        # The data pass of a lazy handle replaces hfile.entity, so run it before taking the list
+        hfile.load_counts()
+        electrodes = sorted({e.electrode_id for e in hfile.entity if e.entity_type == 'Segment'})
+    trains = []
+    for electrode_id in electrodes:
+        ns_result, times = get_event_times(hfile, electrode_id, reason)
+        if ns_result != 'ns_OK':
+            return ns_result, electrodes, None
+        trains.append(times.astype(np.int64))
+    return 'ns_OK', list(electrodes), trains
+
+
+def align_to_triggers(times, triggers, start, stop):
+    """Events of a sorted spike train within [trigger + start, trigger + stop) of each trigger.
+
+    Returns (trials, offsets): the trigger index of every aligned event and its time
+    relative to that trigger. Each trigger costs two binary searches; the events are
+    gathered without a Python loop.
+    """
+    triggers = np.asarray(triggers, dtype=np.int64)
+    first = np.searchsorted(times, triggers + start)
+    last = np.searchsorted(times, triggers + stop)
+    n_events = last - first
+
+    trials = np.repeat(np.arange(len(triggers)), n_events)
+    # Index of every aligned event: the first index of its trial plus its rank in the trial
+    ends = np.cumsum(n_events)
+    indices = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - n_events - first, n_events)
+    return trials, times[indices] - triggers[trials]
+
+
+def bin_counts(trains, bin_width, t0=None, t1=None):
+    """Spike counts of several trains in common bins of bin_width.
+
+    The bins cover [t0, t1), by default the span of all spikes. Returns (counts,
+    edges) with counts of shape (n_trains, n_bins).
+    """
+    nonempty = [times for times in trains if len(times)]
+    if t0 is None:
+        t0 = min((int(times[0]) for times in nonempty), default=0)
+    if t1 is None:
+        t1 = max((int(times[-1]) + 1 for times in nonempty), default=t0 + bin_width)
+    n_bins = max(-(-(t1 - t0) // bin_width), 1)
+
+    # One bincount over (train, bin) pairs for all trains at once
+    rows = np.repeat(np.arange(len(trains)), [len(times) for times in trains])
+    times = np.concatenate(trains) if trains else np.empty(0, dtype=np.int64)
+    keep = (times >= t0) & (times < t1)
+    bins = (times[keep] - t0) // bin_width
+    counts = np.bincount(rows[keep] * n_bins + bins, minlength=len(trains) * n_bins)
+    return counts.reshape(len(trains), n_bins), t0 + bin_width * np.arange(n_bins + 1)
+
+
+def peri_event_histogram(trains, triggers, start, stop, bin_width, per_trial=False):
+    """PSTH of several trains around a set of triggers.
+
+    Events within [start, stop) of each trigger (relative times, e.g. start=-3000 for
+    100 ms before at 30 kHz) are counted in bins of bin_width. Returns (counts, edges)
+    with counts of shape (n_trains, n_bins), or (n_trains, n_triggers, n_bins) with
+    per_trial=True; divide by the number of triggers and the bin width for a rate.
+    """
+    n_bins = max(-(-(stop - start) // bin_width), 1)
+    n_trials = len(triggers)
+    size = n_trials * n_bins if per_trial else n_bins
+    counts = np.zeros((len(trains), size), dtype=np.int64)
+
+    for i, times in enumerate(trains):
+        trials, offsets = align_to_triggers(times, triggers, start, stop)
+        bins = (offsets - start) // bin_width
+        if per_trial:
+            bins = trials * n_bins + bins
+        counts[i] = np.bincount(bins, minlength=size)
+
+    if per_trial:
+        counts = counts.reshape(len(trains), n_trials, n_bins)
+    return counts, start + bin_width * np.arange(n_bins + 1)
+
+
+def plot_raster(ax, trains, row_offset=0, time_scale=1 / 30000, height=0.5, **kwargs):
+    """Draw spike trains as a single line artist, train i on row row_offset + i.
+
+    Every spike is a vertical tick; the ticks are joined into one NaN-separated line,
+    which matplotlib draws far faster than a LineCollection of the same segments.
+    Times are multiplied by time_scale (seconds at 30 kHz by default). Extra keyword
+    arguments (color, linewidth, label, ...) go to the Line2D, which is returned.
+    Call once per channel group to give groups their own style.
+    """
+    from matplotlib.lines import Line2D
+
+    rows = np.repeat(np.arange(len(trains), dtype=np.float64) + row_offset, [len(times) for times in trains])
+    x = np.concatenate(trains).astype(np.float64) * time_scale if trains else np.empty(0)
+
+    # Three vertices per spike: bottom and top of the tick, then a NaN break
+    xs = np.full(3 * len(x), np.nan)
+    ys = np.full(3 * len(x), np.nan)
+    xs[0::3] = xs[1::3] = x
+    ys[0::3] = rows - height / 2
+    ys[1::3] = rows + height / 2
+
+    kwargs.setdefault('color', 'k')
+    kwargs.setdefault('linewidth', 0.5)
+    line = Line2D(xs, ys, **kwargs)
+    ax.add_line(line)
+    ax.autoscale_view()
+    return line
+
+
+def plot_psth(ax, counts, edges, time_scale=1 / 30000, n_triggers=None, **kwargs):
+    """Draw histograms (one row of counts per train) as steps over edges.
+
+    With n_triggers the counts are converted to a rate per second (per time_scale
+    unit). Returns the list of StepPatch objects.
+    """
+    counts = np.atleast_2d(counts).astype(np.float64)
+    x = np.asarray(edges) * time_scale
+    if n_triggers:
+        counts = counts / (n_triggers * (x[1] - x[0]))
+    return [ax.stairs(row, x, **kwargs) for row in counts]
@@ -0,0 +1,62 @@
+import numpy as np
+
+# Bytes per waveform sample in NEUEVWAV headers: 0 and 1 both mean 1 byte
+waveform_sample_dtypes = {0: 'i1', 1: 'i1', 2: '<i2', 4: '<i4'}
+
+
+def waveform_dtype(bytes_data_packet, bytes_per_waveform):
+    """Structured dtype exposing the waveform that follows the 8 byte NEV packet header."""
+    sample_dtype = np.dtype(waveform_sample_dtypes[bytes_per_waveform])
+    n_samples = (bytes_data_packet - 8) // sample_dtype.itemsize
+    return np.dtype({
+        'names': ['Waveform'],
+        'formats': [(sample_dtype, (n_samples,))],
+        'offsets': [8],
+        'itemsize': bytes_data_packet,
+    })
+
+
+def waveform_view(file_info, bytes_per_waveform):
+    """Memory-mapped (n_data_packets, n_samples) view of the waveforms of a NEV file."""
+    if file_info.waveforms is None:
+        file_info.waveforms = {}
+    if bytes_per_waveform not in file_info.waveforms:
+        n_data_packets = len(file_info.memory_map)
+        packets = np.memmap(file_info.file_name, mode='r', offset=file_info.bytes_headers,
+                            dtype=waveform_dtype(file_info.bytes_data_packet, bytes_per_waveform),
+                            shape=(n_data_packets,))
+        file_info.waveforms[bytes_per_waveform] = packets['Waveform']
+    return file_info.waveforms[bytes_per_waveform]
+
+
+def get_segment_data(hfile, entity, indices=None, scale=True):
+    """Read the spike waveforms of a Segment entity.
+
+    entity is an Entity or an index into hfile.entity. indices selects waveforms by
+    their position among the entity's events (an int, slice or array; all when None).
+    The matching packets are found through the per-electrode event index and
+    gathered from the memory-mapped file in one operation.
+
+    Returns (ns_result, data) with data of shape (n_spikes, n_samples), converted to
+    entity units when scale=True.
+    """
+    entity = hfile.get_entity(entity)
+    file_info = entity.file_info
+
+    if entity.entity_type != 'Segment' or file_info is None or file_info.event_index is None:
+        return 'ns_BADENTITY', None
+    if entity.bytes_per_waveform not in waveform_sample_dtypes:
+        return 'ns_BADENTITY', None
+
+    packet_indices = file_info.event_index.packet_indices(entity.electrode_id)
+    if indices is not None:
+        try:
+            packet_indices = packet_indices[indices]
+        except IndexError:
+            return 'ns_BADINDEX', None
+    data = waveform_view(file_info, entity.bytes_per_waveform)[np.atleast_1d(packet_indices)]
+
+    if scale:
+        data = data * entity.scale
+
+    return 'ns_OK', data
@@ -0,0 +1,135 @@
+import contextlib
+import sys
+import time
+
+# Instrumentation of ns_openfile. With stats enabled every FileInfo gets an OpenStats
+# with the time spent in each phase of the open, the bytes read and seeks made through
+# the reader's file handles, and whether the NEV cache was reused. When disabled,
+# file_info.stats is None and the phases cost one shared no-op context manager each.
+
+LOGGER_NAME = 'ns_openfile'
+
+NO_PHASE = contextlib.nullcontext()
+
+
+class OpenStats:
+    """Per-phase timings (seconds), I/O counters and cache outcome of opening one file.
+
+    cache is 'hit' when an existing NEV cache was reused, 'extend' when the packets
+    appended to the file since were added to it, 'miss' when it was built, and None
+    for NSx files. bytes_read and seeks count the reads made by the reader
+    itself; pages of memory-mapped files touched later are not included.
+    """
+    __slots__ = ('file_name', 'phases', 'bytes_read', 'seeks', 'cache')
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.phases = {}
+        self.bytes_read = 0
+        self.seeks = 0
+        self.cache = None
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def as_dict(self):
+        return {
+            'file_name': self.file_name,
+            'phases': dict(self.phases),
+            'total': self.total,
+            'bytes_read': self.bytes_read,
+            'seeks': self.seeks,
+            'cache': self.cache,
+        }
+
+    def __repr__(self):
+        phases_str = ''.join(f"\t\t{name}: {seconds * 1e3:.3f} ms\n" for name, seconds in self.phases.items())
+        return (
+            f"\nOpenStats:\n"
+            f"\tfile_name: {self.file_name}\n"
+            f"\tphases:\n{phases_str}"
+            f"\ttotal: {self.total * 1e3:.3f} ms\n"
+            f"\tbytes_read: {self.bytes_read}\n"
+            f"\tseeks: {self.seeks}\n"
+            f"\tcache: {self.cache}\n"
+        )
+
+
+class Phase:
+    """Context manager adding the time spent in its block to one phase of an OpenStats."""
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        phases = self.stats.phases
+        phases[self.name] = phases.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+def phase(stats, name):
+    """Time a phase when stats is an OpenStats; a no-op when it is None."""
+    return NO_PHASE if stats is None else Phase(stats, name)
+
+
+class CountingFile:
+    """Binary file wrapper counting the bytes read and the seeks made through it."""
+    __slots__ = ('fid', 'stats')
+
+    def __init__(self, fid, stats):
+        self.fid = fid
+        self.stats = stats
+
+    def read(self, size=-1):
+        data = self.fid.read(size)
+        self.stats.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        self.stats.seeks += 1
+        return self.fid.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self.fid, name)
+
+
+def counting_file(fid, stats):
+    return fid if stats is None else CountingFile(fid, stats)
+
+
+def debug_logger():
+    """The ns_openfile logger if it logs DEBUG messages, else None.
+
+    logging is not imported here: if the application has not imported it, no logger
+    can be configured, and the import would slow down every import of ns_openfile.
+    """
+    logging = sys.modules.get('logging')
+    if logging is None:
+        return None
+    logger = logging.getLogger(LOGGER_NAME)
+    return logger if logger.isEnabledFor(logging.DEBUG) else None
+
+
+def stats_enabled(stats, stats_callback):
+    return bool(stats) or stats_callback is not None or debug_logger() is not None
+
+
+def emit_stats(stats, stats_callback=None):
+    """Send the stats of a finished open to the logger (at DEBUG level) and the callback."""
+    logger = debug_logger()
+    if logger is not None:
+        phases = ', '.join(f"{name} {seconds * 1e3:.2f} ms" for name, seconds in stats.phases.items())
+        logger.debug("%s: %.2f ms (%s), %d bytes read, %d seeks, cache %s", stats.file_name,
+                     stats.total * 1e3, phases, stats.bytes_read, stats.seeks, stats.cache)
+    if stats_callback is not None:
+        stats_callback(stats)
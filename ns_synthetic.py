@@ -0,0 +1,127 @@
+import struct
+import numpy as np
+
+# Synthetic Ripple files for benchmarks and checks. The files follow the header
+# layout read by ns_openfile, and the data is drawn from a seeded generator so the
+# same arguments always give the same file.
+
+# Digital events carry the parallel word at byte 8 and the four SMA levels after it
+MIN_BYTES_DATA_PACKET = 18
+
+
+def spike_shape(n_samples):
+    """Peak-aligned spike shape in int16 bits, for the waveforms of synthetic spikes."""
+    t = np.arange(n_samples)
+    shape = -600 * np.exp(-0.5 * ((t - 14) / 2.5) ** 2) + 250 * np.exp(-0.5 * ((t - 24) / 6.0) ** 2)
+    return shape.astype(np.int16)
+
+
+def nev_headers(n_electrodes, bytes_data_packet, n_digital_labels=5):
+    # Basic header: File Type ID, File Spec, Additional Flags, BytesHeaders,
+    # BytesDataPacket, Time Resolutions, Time Origin, Application, Comment
+    n_extended_headers = 2 * n_electrodes + n_digital_labels
+    bytes_headers = 336 + 32 * n_extended_headers
+    header = b'NEURALEV' + struct.pack('<BBHII', 2, 2, 1, bytes_headers, bytes_data_packet)
+    header += struct.pack('<II', 30000, 30000) + bytes(16)
+    header += b'synthetic'.ljust(32, b'\x00') + bytes(256)
+    header += struct.pack('<I', n_extended_headers)
+
+    # Extended headers: one NEUEVWAV and one NEUEVLBL per electrode, then the DIGLABELs
+    for elec_id in range(5121, 5121 + n_electrodes):
+        header += b'NEUEVWAV' + struct.pack('<HBBHhhhBBf', elec_id, 1, 1, 0, 0, 0, 0, 0, 2, 5e-4)
+        header += bytes(6)
+    for elec_id in range(5121, 5121 + n_electrodes):
+        label = f'elec {elec_id - 5120}'.encode('utf-8').ljust(16, b'\x00')
+        header += b'NEUEVLBL' + struct.pack('<H', elec_id) + label + bytes(6)
+    for j in range(n_digital_labels):
+        label = (f'SMA {j + 1}' if j < 4 else 'parallel').encode('utf-8').ljust(16, b'\x00')
+        header += b'DIGLABEL' + label + struct.pack('<B', 1) + bytes(7)
+
+    return header
+
+
+def synthetic_nev_packets(rng, n_packets, n_electrodes, bytes_data_packet, digital_fraction,
+                          parallel_fraction, time_stamp=0):
+    """Structured array of NEV data packets: spikes on n_electrodes and digital events.
+
+    A digital_fraction of the packets are digital events (PacketID 0); of those a
+    parallel_fraction are parallel port words (Class bit 0, 16 bit word at byte 8)
+    and the rest are SMA edges (Class bits 1-4, alternately rising and falling).
+    Spikes carry a noisy spike waveform and a unit class between 0 and 2. Timestamps
+    continue from time_stamp. Packets need at least 18 bytes for the digital payload.
+    """
+    if bytes_data_packet < MIN_BYTES_DATA_PACKET:
+        raise ValueError(f"bytes_data_packet must be at least {MIN_BYTES_DATA_PACKET} to hold the "
+                         f"parallel word and SMA levels of digital events, got {bytes_data_packet}")
+    n_samples = (bytes_data_packet - 8) // 2
+    packets = np.zeros(n_packets, dtype=[('TimeStamp', '<u4'), ('PacketID', '<u2'), ('Class', 'u1'),
+                                         ('Reserved', 'u1'), ('Waveform', '<i2', n_samples),
+                                         ('Padding', 'u1', bytes_data_packet - 8 - 2 * n_samples)])
+    packets['TimeStamp'] = time_stamp + np.cumsum(rng.integers(1, 30, n_packets))
+
+    digital = rng.random(n_packets) < digital_fraction
+    parallel = digital & (rng.random(n_packets) < parallel_fraction)
+    packets['PacketID'] = np.where(digital, 0, rng.integers(5121, 5121 + n_electrodes, n_packets))
+    packets['Class'] = np.where(digital, 1 << rng.integers(1, 5, n_packets), rng.integers(0, 3, n_packets))
+    packets['Class'][parallel] = 1
+
+    noise = rng.integers(-40, 40, (n_packets, n_samples), dtype=np.int16)
+    packets['Waveform'] = np.where(digital[:, None], 0, spike_shape(n_samples) + noise)
+    words = rng.integers(0, 1 << 16, int(parallel.sum()), dtype=np.uint16)
+    packets['Waveform'][parallel, 0] = words.view('<i2')
+
+    # The level of SMA input j after each of its edges is at byte 8 + 2j: high, low, ...
+    for j in range(1, 5):
+        edges = np.flatnonzero(digital & (packets['Class'] == 1 << j))
+        packets['Waveform'][edges[::2], j] = 0x7fff
+
+    return packets
+
+
+def write_synthetic_nev(filepath, n_packets, n_electrodes=32, bytes_data_packet=112, digital_fraction=0.1,
+                        parallel_fraction=0.25, seed=0, chunk_packets=1 << 18, time_stamp=0):
+    """Write a NEV file with n_packets data packets, generated chunk_packets at a time.
+
+    Timestamps start after time_stamp and wrap around at 2**32 like the 32-bit counter.
+    """
+    rng = np.random.default_rng(seed)
+    with open(filepath, 'wb') as fid:
+        fid.write(nev_headers(n_electrodes, bytes_data_packet))
+        for start in range(0, n_packets, chunk_packets):
+            n = min(chunk_packets, n_packets - start)
+            packets = synthetic_nev_packets(rng, n, n_electrodes, bytes_data_packet, digital_fraction,
+                                            parallel_fraction, time_stamp)
+            fid.write(packets.tobytes())
+            time_stamp = int(packets['TimeStamp'][-1])
+
+
+def write_synthetic_nsx(filepath, n_points, chan_count=32, n_blocks=1, period=1, float_stream=False,
+                        seed=0):
+    """Write an NSx file (NEURALCD, or NEUCDFLT when float_stream=True) with n_points samples
+    per channel split into n_blocks data blocks separated by pauses."""
+    # Basic header: File Type ID, File Spec, BytesHeaders, Label, Comment, Period,
+    # Time Resolution, Time Origin, Channel Count
+    bytes_headers = 314 + 66 * chan_count
+    header = (b'NEUCDFLT' if float_stream else b'NEURALCD') + struct.pack('<BBI', 2, 3, bytes_headers)
+    header += b'synthetic'.ljust(16, b'\x00') + bytes(256)
+    header += struct.pack('<II', period, 30000) + bytes(16) + struct.pack('<I', chan_count)
+
+    # Extended headers: one CC header per channel, +-8192 uV over the int16 range
+    for j in range(chan_count):
+        label = f'raw {j + 1}'.encode('utf-8').ljust(16, b'\x00')
+        header += b'CC' + struct.pack('<H', j + 1) + label + bytes(2)
+        header += struct.pack('<4h', -32768, 32767, -8192, 8191) + b'uV'.ljust(16, b'\x00') + bytes(20)
+
+    # Data packets: n_blocks blocks separated by a pause, written in bounded pieces
+    rng = np.random.default_rng(seed)
+    dtype = '<f4' if float_stream else '<i2'
+    time_stamp = 0
+    with open(filepath, 'wb') as fid:
+        fid.write(header)
+        for n_block in np.array_split(np.arange(n_points), n_blocks):
+            fid.write(struct.pack('<BII', 1, time_stamp, len(n_block)))
+            for start in range(0, len(n_block), 1 << 18):
+                n = min(1 << 18, len(n_block) - start)
+                samples = rng.integers(-2000, 2000, (n, chan_count))
+                fid.write(samples.astype(dtype).tobytes())
+            time_stamp += (len(n_block) + 1000) * period
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Columnar view of the entities of a handle. For sessions with thousands of entities
+# a structured array is faster to filter and sort than the list of Entity objects,
+# and much smaller to keep around.
+
+ENTITY_TYPES = ('Unknown', 'Event', 'Analog', 'Segment', 'Neural')
+
+# Reasons of digital Event entities, stored in the reason column as their class bit
+DIGITAL_REASONS = ('Parallel Input', 'SMA 1', 'SMA 2', 'SMA 3', 'SMA 4', 'Output Echo')
+
+entity_table_dtype = np.dtype([
+    ('electrode_id', '<u2'),
+    ('type', 'u1'),      # index into ENTITY_TYPES
+    ('reason', '<i2'),   # class (Neural), class bit (Event) or -1
+    ('count', '<u8'),
+    ('scale', '<f8'),    # NaN when the entity has no scale
+    ('label', '<i4'),    # index into EntityTable.labels, -1 when there is no label
+    ('file', '<u2'),     # index into hfile.file_infos
+])
+
+
+class EntityTable:
+    """Structured array with one row per entity of hfile.entity, in the same order.
+
+    Building the table loads the data section of lazily opened files, since it needs
+    the entity counts, and the rows are those of hfile.entity after that load.
+    """
+    __slots__ = ('rows', 'labels')
+
+    def __init__(self, hfile):
+        # The data pass of a lazy handle replaces hfile.entity, so run it before taking the list
+        hfile.load_counts()
+        entities = hfile.entity
+        self.rows = np.empty(len(entities), dtype=entity_table_dtype)
+        self.labels = []
+        label_index = {}
+        file_index = {id(file_info): i for i, file_info in enumerate(hfile.file_infos)}
+
+        columns = []
+        for entity in entities:
+            entity_type = entity.entity_type
+            if entity_type == 'Event':
+                reason = DIGITAL_REASONS.index(entity.reason) if entity.reason in DIGITAL_REASONS else -1
+            elif entity.reason is None:
+                reason = -1
+            else:
+                reason = int(entity.reason)
+
+            label = entity.label
+            if label is None:
+                i_label = -1
+            else:
+                i_label = label_index.setdefault(label, len(label_index))
+                if i_label == len(self.labels):
+                    self.labels.append(label)
+
+            columns.append((
+                entity.electrode_id or 0,
+                ENTITY_TYPES.index(entity_type) if entity_type in ENTITY_TYPES else 0,
+                reason,
+                entity.count,
+                np.nan if entity.scale is None else entity.scale,
+                i_label,
+                file_index.get(id(entity.file_info), 0),
+            ))
+        self.rows[:] = columns
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+    def select(self, entity_type=None, electrode_id=None, reason=None):
+        """Indices into hfile.entity of the entities matching every given field."""
+        mask = np.ones(len(self.rows), dtype=bool)
+        if entity_type is not None:
+            mask &= self.rows['type'] == ENTITY_TYPES.index(entity_type)
+        if electrode_id is not None:
+            mask &= np.isin(self.rows['electrode_id'], electrode_id)
+        if reason is not None:
+            if isinstance(reason, str):
+                reason = DIGITAL_REASONS.index(reason)
+            mask &= self.rows['reason'] == reason
+        return np.flatnonzero(mask)
+
+    def label(self, i_entity):
+        i_label = self.rows['label'][i_entity]
+        return self.labels[i_label] if i_label >= 0 else None
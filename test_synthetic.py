@@ -0,0 +1,355 @@
+import json
+import os
+import struct
+import threading
+import numpy as np
+import pytest
+from ns_analog import get_analog_data, iter_analog_chunks
+from ns_batch import index_sessions, open_session
+from ns_cache import CacheHeader, cache_file_path, count_cache_keys, fill_nev_cache, nev_packet_dtype, \
+    write_key_counts
+from ns_events import get_event_times, get_events_in_window, get_events_in_windows
+from ns_export import export_nev, export_nsx
+from ns_filters import BandpassFilter, Decimator
+from ns_follow import follow_nev
+from ns_openfile import ns_closefile, ns_openfile
+from ns_segment import waveform_view
+from ns_synthetic import write_synthetic_nev, write_synthetic_nsx
+
+# Checks of the NEV cache, event queries, batch manifests, filters and exports on
+# synthetic files, run with pytest. Results are compared with a plain NumPy read of
+# the raw file, or with a regular open of the same file.
+
+
+def nev_layout(filepath):
+    """(bytes_headers, bytes_data_packet) of a NEV file."""
+    with open(filepath, 'rb') as fid:
+        fid.seek(12)
+        return struct.unpack('<II', fid.read(8))
+
+
+def read_packets(filepath):
+    bytes_headers, bytes_data_packet = nev_layout(filepath)
+    n_data_packets = (os.path.getsize(filepath) - bytes_headers) // bytes_data_packet
+    return np.fromfile(filepath, dtype=nev_packet_dtype(bytes_data_packet), count=n_data_packets,
+                       offset=bytes_headers)
+
+
+def entity_rows(hfile):
+    return [(e.entity_type, e.electrode_id, e.reason, e.count, e.label) for e in hfile.entity]
+
+
+def check_nev(hfile, packets):
+    """The memory map, entity counts and event lookups of hfile match packets."""
+    file_info = hfile.file_info
+    for name in ('TimeStamp', 'PacketID', 'Class'):
+        assert np.array_equal(file_info.memory_map[name], packets[name])
+    for entity in hfile.entity:
+        if entity.entity_type == 'Segment':
+            expected = packets['TimeStamp'][packets['PacketID'] == entity.electrode_id]
+            ns_result, times = get_event_times(hfile, entity.electrode_id)
+            assert ns_result == 'ns_OK' and entity.count == len(expected)
+            assert np.array_equal(times, expected)
+
+
+def open_stats(filepath, **kwargs):
+    ns_result, hfile = ns_openfile(str(filepath), single=True, stats=True, **kwargs)
+    assert ns_result == 'ns_OK'
+    return hfile, hfile.file_info.stats
+
+
+def append(filepath, raw, size):
+    """Grow filepath to the first size bytes of raw."""
+    with open(filepath, 'ab') as fid:
+        fid.write(raw[os.path.getsize(filepath):size])
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """A NEV file and its raw bytes, to write growing copies from."""
+    filepath = tmp_path / 'full.nev'
+    write_synthetic_nev(filepath, 40000, n_electrodes=8, seed=1)
+    return filepath, filepath.read_bytes()
+
+
+def test_cache_extends_growing_file(tmp_path, recording):
+    full, raw = recording
+    bytes_headers, bytes_data_packet = nev_layout(full)
+    packets = read_packets(full)
+    size = lambda n: bytes_headers + n * bytes_data_packet
+    filepath = tmp_path / 'growing.nev'
+    filepath.write_bytes(raw[:size(10000)])
+
+    # Built from scratch, then rebuilt with room to grow once the file outgrows it
+    for n, outcome in ((10000, 'miss'), (15000, 'miss'), (25000, 'extend'), (30000, 'extend')):
+        append(filepath, raw, size(n))
+        hfile, stats = open_stats(filepath)
+        assert stats.cache == outcome
+        if outcome == 'extend':
+            assert stats.bytes_read < size(n - 14000)
+        check_nev(hfile, packets[:n])
+        ns_closefile(hfile)
+
+    # A trailing partial packet only refreshes the cache header
+    append(filepath, raw, size(30000) + bytes_data_packet // 2)
+    hfile, stats = open_stats(filepath)
+    assert stats.cache == 'hit'
+    check_nev(hfile, packets[:30000])
+    ns_closefile(hfile)
+
+    append(filepath, raw, size(40000))
+    hfile, stats = open_stats(filepath)
+    assert stats.cache == 'miss'
+    check_nev(hfile, packets)
+    ns_closefile(hfile)
+
+    hfile, stats = open_stats(full)
+    reference = entity_rows(hfile)
+    ns_closefile(hfile)
+    hfile, stats = open_stats(filepath)
+    assert stats.cache == 'hit' and entity_rows(hfile) == reference
+    ns_closefile(hfile)
+
+
+@pytest.mark.parametrize('key_table', [False, True])
+def test_interrupted_append(tmp_path, recording, key_table):
+    full, raw = recording
+    bytes_headers, bytes_data_packet = nev_layout(full)
+    packets = read_packets(full)
+    filepath = tmp_path / 'growing.nev'
+    filepath.write_bytes(raw[:bytes_headers + 10000 * bytes_data_packet])
+    cache_file_name = cache_file_path(filepath)
+    for _ in follow_nev(filepath, timeout=0):
+        pass
+
+    # Write the new packets (and key table) of an append, but stop before its header
+    append(filepath, raw, bytes_headers + 15000 * bytes_data_packet)
+    cached = CacheHeader.read(cache_file_name)
+    header = CacheHeader.from_source(filepath, bytes_headers, bytes_data_packet, 15000)
+    header.capacity = cached.capacity
+    fill_nev_cache(filepath, cache_file_name, header, 10000, 15000)
+    if key_table:
+        with open(cache_file_name, 'r+b') as cache_id:
+            write_key_counts(cache_id, header, *count_cache_keys(cache_id, header, 0, 15000))
+
+    hfile, stats = open_stats(filepath)
+    assert stats.cache == ('miss' if key_table else 'extend')
+    check_nev(hfile, packets[:15000])
+    ns_closefile(hfile)
+
+
+def test_follow_and_reopen_while_recording(tmp_path, recording):
+    full, raw = recording
+    packets = read_packets(full)
+    bytes_headers, bytes_data_packet = nev_layout(full)
+    filepath = tmp_path / 'recording.nev'
+    filepath.write_bytes(raw[:bytes_headers + 1000 * bytes_data_packet])
+
+    def record():
+        # Writes end in the middle of packets, as a recorder flushing its buffers would
+        for size in range(len(raw) // 8, len(raw), 50001):
+            append(filepath, raw, size)
+            threading.Event().wait(0.002)
+        append(filepath, raw, len(raw))
+
+    followed = []
+
+    def follow():
+        followed.extend(follow_nev(filepath, poll_interval=0.001, from_start=True, max_packets=3000,
+                                   timeout=0.5))
+
+    threads = [threading.Thread(target=record), threading.Thread(target=follow)]
+    for thread in threads:
+        thread.start()
+    # Reopen the file while it grows; opens and the follower extend the same cache
+    while threads[0].is_alive():
+        ns_result, hfile = ns_openfile(str(filepath), single=True)
+        check_nev(hfile, packets[:len(hfile.file_info.memory_map)])
+        ns_closefile(hfile)
+    for thread in threads:
+        thread.join()
+
+    assert np.array_equal(np.concatenate([events['Index'] for events in followed]), np.arange(len(packets)))
+    for name in ('TimeStamp', 'PacketID', 'Class'):
+        assert np.array_equal(np.concatenate([events[name] for events in followed]), packets[name])
+    hfile, stats = open_stats(filepath)
+    assert stats.cache in ('hit', 'extend')
+    check_nev(hfile, packets)
+    ns_closefile(hfile)
+
+
+def test_windows_across_wraparound(tmp_path):
+    filepath = tmp_path / 'wrap.nev'
+    write_synthetic_nev(filepath, 20000, n_electrodes=4, time_stamp=2 ** 32 - 150000)
+    packets = read_packets(filepath)
+    times = packets['TimeStamp'].astype(np.int64)
+    times[1:] += np.cumsum(times[1:] < times[:-1]) << 32
+    assert times[-1] > 2 ** 32 > times[0]
+
+    ns_result, hfile = ns_openfile(str(filepath))
+    rng = np.random.default_rng(0)
+    t0 = rng.integers(times[0] - 1000, times[-1], 50)
+    t0[:3] = 2 ** 32 - 5000, 2 ** 32, times[0]
+    t1 = t0 + rng.integers(0, 20000, 50)
+    for a, b in zip(t0, t1):
+        ns_result, events = get_events_in_window(hfile, a, b)
+        in_window = (times >= a) & (times < b)
+        assert np.array_equal(events['TimeStamp'], packets['TimeStamp'][in_window])
+
+    ns_result, events = get_events_in_windows(hfile, t0, t1, electrodes=[5121, 5122])
+    for i, (a, b) in enumerate(zip(t0, t1)):
+        selected = (times >= a) & (times < b) & np.isin(packets['PacketID'], [5121, 5122])
+        window = slice(events['Offsets'][i], events['Offsets'][i + 1])
+        assert np.array_equal(events['TimeStamp'][window], packets['TimeStamp'][selected])
+        assert np.all(events['Window'][window] == i)
+    ns_closefile(hfile)
+
+
+def test_manifest_reopen(tmp_path):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    session = str(data_dir / 'session')
+    write_synthetic_nev(session + '.nev', 20000, n_electrodes=6, seed=2)
+    write_synthetic_nsx(session + '.ns5', 20000, chan_count=4, n_blocks=2, seed=2)
+    cache_dir = str(tmp_path / 'cache')
+    manifest = str(tmp_path / 'manifest.json')
+
+    result = index_sessions(str(data_dir), max_workers=2, cache_dir=cache_dir, manifest=manifest,
+                            progress=None)
+    assert [summary['status'] for summary in result['sessions']] == ['ok']
+
+    def check_same(hfile, reference):
+        assert entity_rows(hfile) == entity_rows(reference)
+        assert hfile.time_span == reference.time_span
+        for entity, expected in zip(hfile.entity, reference.entity):
+            if entity.entity_type == 'Segment':
+                assert np.array_equal(get_event_times(hfile, entity.electrode_id)[1],
+                                      get_event_times(reference, entity.electrode_id)[1])
+            elif entity.entity_type == 'Analog':
+                assert np.array_equal(get_analog_data(hfile, entity)[1],
+                                      get_analog_data(reference, expected)[1])
+
+    ns_result, reference = ns_openfile(session + '.nev', cache_dir=cache_dir)
+    ns_result, hfile = open_session(manifest, session + '.nev', lazy=True)
+    assert ns_result == 'ns_OK' and all(file_info.counted for file_info in hfile.file_infos)
+    check_same(hfile, reference)
+    ns_closefile(hfile)
+
+    # A file changed since the batch run is opened as usual
+    with open(session + '.nev', 'ab') as fid:
+        fid.write(open(session + '.nev', 'rb').read()[-2 * nev_layout(session + '.nev')[1]:])
+    ns_closefile(reference)
+    ns_result, reference = ns_openfile(session, cache_dir=cache_dir)
+    ns_result, hfile = open_session(manifest, session)
+    assert not any(file_info.counted for file_info in hfile.file_infos)
+    check_same(hfile, reference)
+    ns_closefile(hfile)
+    ns_closefile(reference)
+
+
+def test_filters_match_whole_block(tmp_path):
+    filepath = tmp_path / 'analog.ns5'
+    write_synthetic_nsx(filepath, 60000, chan_count=3, n_blocks=2)
+    ns_result, hfile = ns_openfile(str(filepath))
+    channels = [0, 1, 2]
+    make_stages = lambda: [Decimator(5), BandpassFilter(300, 2000, 6000)]
+
+    def filtered(chunk_samples):
+        ns_result, chunks = iter_analog_chunks(hfile, channels, chunk_samples, stages=make_stages())
+        blocks = {}
+        for chunk in chunks:
+            blocks.setdefault(chunk['Block'], []).append(chunk)
+        return blocks
+
+    whole = filtered(10 ** 6)
+    for chunk_samples in (997, 4096, 25000):
+        for i_block, chunks in filtered(chunk_samples).items():
+            assert chunks[0]['TimeStamp'] == whole[i_block][0]['TimeStamp']
+            assert chunks[0]['Period'] == whole[i_block][0]['Period']
+            assert np.allclose(np.concatenate([chunk['Data'] for chunk in chunks]), whole[i_block][0]['Data'],
+                               rtol=0, atol=1e-6)
+
+    # Each block is filtered on its own, as one array run through fresh stages
+    block_starts = [0, *np.cumsum(hfile.file_info.blocks['NumPoints']).tolist()]
+    for i_block, chunks in whole.items():
+        ns_result, data = get_analog_data(hfile, channels, block_starts[i_block],
+                                          block_starts[i_block + 1] - block_starts[i_block])
+        for stage in make_stages():
+            data = stage(data)
+        assert np.allclose(chunks[0]['Data'], data, rtol=0, atol=1e-6)
+    ns_closefile(hfile)
+
+
+def test_bandpass_low_corner():
+    with pytest.raises(ValueError):
+        BandpassFilter(1, 250, 30000, n_taps=2001)
+    stage = BandpassFilter(1, 250, 1000)
+    t = np.arange(20000)[:, None] / 1000
+    data = stage(500 + np.sin(2 * np.pi * 20 * t))[len(stage.taps):]
+    assert abs(data.mean()) < 2 and np.isclose(data.std(), np.sqrt(0.5), rtol=0.01)
+
+
+def read_export(filename, format):
+    """Columns (as NumPy arrays) and ns_export metadata of an exported file."""
+    if format == 'hdf5':
+        h5py = pytest.importorskip('h5py')
+        with h5py.File(filename, 'r') as h5:
+            return {name: h5[name][()] for name in h5}, json.loads(h5.attrs['ns_export'])
+
+    pa = pytest.importorskip('pyarrow')
+    if format == 'parquet':
+        table = pytest.importorskip('pyarrow.parquet').read_table(filename)
+    else:
+        with pa.ipc.open_file(filename) as reader:
+            table = reader.read_all()
+    columns = {}
+    for name in table.column_names:
+        column = table[name].combine_chunks()
+        if isinstance(column.type, pa.FixedSizeListType):
+            columns[name] = column.flatten().to_numpy().reshape(len(column), column.type.list_size)
+        else:
+            columns[name] = column.to_numpy()
+    return columns, json.loads(table.schema.metadata[b'ns_export'])
+
+
+@pytest.mark.parametrize('format,extension', [('parquet', '.parquet'), ('arrow', '.arrow'), ('hdf5', '.h5')])
+def test_export_round_trip(tmp_path, format, extension):
+    pytest.importorskip('h5py' if format == 'hdf5' else 'pyarrow')
+    filepath = tmp_path / 'session.nev'
+    write_synthetic_nev(filepath, 5000, n_electrodes=4)
+    write_synthetic_nsx(tmp_path / 'session.ns5', 7000, chan_count=3, n_blocks=2)
+    ns_result, hfile = ns_openfile(str(filepath))
+
+    nev_file = str(tmp_path / ('events' + extension))
+    assert export_nev(hfile, nev_file, waveforms=True, batch_packets=1234) == 'ns_OK'
+    columns, metadata = read_export(nev_file, format)
+    packets = read_packets(filepath)
+    for name in ('TimeStamp', 'PacketID', 'Class'):
+        assert np.array_equal(columns[name], packets[name])
+    assert np.array_equal(columns['Waveform'], waveform_view(hfile.file_info, 2))
+    assert len(metadata['entity']) == len(hfile.file_info.entity)
+
+    nsx_info = hfile.get_file_info('NEURALCD')
+    entities = [e for e in hfile.entity if e.file_info is nsx_info]
+    nsx_file = str(tmp_path / ('samples' + extension))
+    assert export_nsx(hfile, nsx_file, entities, batch_points=1000, scale=True) == 'ns_OK'
+    columns, metadata = read_export(nsx_file, format)
+    ns_result, data = get_analog_data(hfile, entities)
+    assert np.array_equal(np.column_stack([columns[name] for name in metadata['channels']]), data)
+    blocks = nsx_info.blocks
+    period = np.uint64(nsx_info.period)
+    expected = np.concatenate([block['TimeStamp'] + np.arange(block['NumPoints'], dtype=np.uint64) * period
+                               for block in blocks])
+    assert np.array_equal(columns['TimeStamp'], expected)
+    ns_closefile(hfile)
+
+    # A NEV file without data packets exports an empty table and leaves no temporary file
+    empty = tmp_path / 'empty.nev'
+    write_synthetic_nev(empty, 0, n_electrodes=4)
+    ns_result, hfile = ns_openfile(str(empty))
+    empty_file = str(tmp_path / ('empty' + extension))
+    assert export_nev(hfile, empty_file, waveforms=True) == 'ns_OK'
+    columns, metadata = read_export(empty_file, format)
+    assert len(columns['TimeStamp']) == 0
+    assert not os.path.exists(empty_file + '.tmp')
+    ns_closefile(hfile)